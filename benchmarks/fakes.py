@@ -0,0 +1,172 @@
+"""Offline stand-ins for Steam, the request code endpoint and the CDN, and synthetic inputs for the benchmarks."""
+
+import io
+import random
+import threading
+import zipfile
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, NamedTuple, override
+
+from lua2meta.network import CDNPool, SteamSession
+
+# appid -> depot -> (gid, size)
+type Catalog = dict[int, dict[int, tuple[int, int]]]
+
+
+class FakeContentServer(NamedTuple):
+    host: str
+    port: int
+    https: bool = False
+    type: str = "CDN"
+
+
+def manifest_bytes(depot: int, gid: int, size: int) -> bytes:
+    # half random, half repeated, so that compression does some work without collapsing the file
+    rng = random.Random(depot * 1_000_003 + gid)
+    block = rng.randbytes(4096)
+    chunks = [rng.randbytes(4096) if i % 2 else block for i in range(size // 4096 + 1)]
+    return b"".join(chunks)[:size]
+
+
+def make_lua(appid: int, depots: dict[int, tuple[int, int]]) -> str:
+    lines = [f"addappid({appid})"]
+    lines += (f'addappid({depot}, 1, "{depot:064x}")' for depot in depots)
+    return "\n".join(lines) + "\n"
+
+
+def make_bundle(
+    path: Path,
+    appid: int,
+    depots: dict[int, tuple[int, int]],
+    bundled: int | None = None,
+    compression: int = zipfile.ZIP_DEFLATED,
+):
+    # the first `bundled` depots come with their manifest, the others have to be fetched
+    with zipfile.ZipFile(path, "w", compression, compresslevel=1) as zip_file:
+        zip_file.writestr(f"{appid}.lua", make_lua(appid, depots))
+        for depot, (gid, size) in list(depots.items())[:bundled]:
+            zip_file.writestr(f"{depot}_{gid}.manifest", manifest_bytes(depot, gid, size))
+
+
+def make_catalog(apps: int, depots: int, size: int, first_appid: int = 1000) -> Catalog:
+    catalog: Catalog = {}
+    for i in range(apps):
+        appid = first_appid + i * (depots + 1)
+        catalog[appid] = {appid + 1 + j: (7_000_000_000_000_000_000 + appid * 1000 + j, size) for j in range(depots)}
+    return catalog
+
+
+class FakeSteam:
+    # serves "/mrc/{appid}/{depot}/{gid}" as the --api-url endpoint and "/depot/{depot}/manifest/{gid}/5/{code}" as a content server
+    catalog: Catalog
+    requests: int
+    _zipped: dict[tuple[int, int], bytes]
+    _server: ThreadingHTTPServer
+    _thread: threading.Thread
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self.requests = 0
+        self._zipped = {}
+        for depots in catalog.values():
+            for depot, (gid, size) in depots.items():
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zip_file:
+                    zip_file.writestr("z", manifest_bytes(depot, gid, size))
+                self._zipped[depot, gid] = buffer.getvalue()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                fake.requests += 1
+                parts = self.path.strip("/").split("/")
+                body: bytes | None = None
+                if len(parts) == 4 and parts[0] == "mrc":
+                    body = b"1234567890"
+                elif len(parts) == 6 and parts[0] == "depot" and parts[2] == "manifest":
+                    body = fake._zipped.get((int(parts[1]), int(parts[3])))
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/mrc/{{appid}}/{{depotid}}/{{manifestid}}"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeSteamClient:
+    catalog: Catalog
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+
+    def get_product_info(self, apps: list[int], meta_data_only: bool = False, auto_access_tokens: bool = True) -> dict[str, Any]:
+        result: dict[int, Any] = {}
+        for appid in apps:
+            if meta_data_only:
+                result[appid] = {"_change_number": 1}
+                continue
+            depots: dict[str, Any] = {
+                str(depot): {"manifests": {"public": {"gid": gid, "size": size}}} for depot, (gid, size) in self.catalog[appid].items()
+            }
+            depots["branches"] = {"public": {"buildid": 1}}
+            result[appid] = {
+                "common": {"name": f"App {appid}"},
+                "config": {"installdir": f"App {appid}"},
+                "depots": depots,
+                "_change_number": 1,
+            }
+        return {"apps": result}
+
+
+class FakeSteamSession(SteamSession):
+    # talks to a FakeSteam instead of logging in and looking up real content servers
+    fake: FakeSteam
+    _fake_client: FakeSteamClient
+
+    def __init__(self, fake: FakeSteam, api_rate: float = 1000):
+        super().__init__(api_rate)
+        self.fake = fake
+        self._fake_client = FakeSteamClient(fake.catalog)
+
+    @override
+    def run_client[T](self, fn: Callable[[Any], T]) -> T:
+        return fn(self._fake_client)
+
+    @property
+    @override
+    def cdn_pool(self) -> CDNPool:
+        with self._lock:
+            if self._cdn_pool is None:
+                self._cdn_pool = CDNPool([FakeContentServer("127.0.0.1", self.fake.port)])
+            return self._cdn_pool
@@ -0,0 +1,48 @@
+"""Wall time of short lua2meta runs, which are dominated by interpreter startup and imports.
+
+usage: python benchmarks/startup.py [RUNS]
+"""
+
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+HEAVY_MODULES = {"steam", "gevent", "requests", "urlpath", "luaparser", "antlr4", "vdf"}
+REPORT = f"print(*sorted({{m.split('.')[0] for m in sys.modules}} & {HEAVY_MODULES!r}), file=sys.stderr)"
+
+
+def bench(name: str, code: str, runs: int):
+    times: list[float] = []
+    loaded = ""
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=False)
+        times.append(time.perf_counter() - start)
+        if process.returncode:
+            sys.exit(f"{name} failed:\n{process.stdout}{process.stderr}")
+        loaded = process.stderr.strip()
+    print(f"{name:<26} median {statistics.median(times) * 1000:7.1f}ms  min {min(times) * 1000:7.1f}ms  heavy modules: {loaded or '-'}")
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(tmp)
+        bundle = out_dir / "480.zip"
+        with zipfile.ZipFile(bundle, "w") as zip_file:
+            zip_file.writestr("480.lua", "addappid(480)\n" + "".join(f'addappid({481 + i}, 1, "{i:064x}")\n' for i in range(8)))
+            for i in range(8):
+                zip_file.writestr(f"{481 + i}_{1000 + i}.manifest", b"\0" * 1024)
+        argv = [str(bundle), "-o", str(out_dir), "--offline", "--dry-download"]
+
+        bench("interpreter", f"import sys; {REPORT}", runs)
+        bench("import lua2meta", f"import sys, lua2meta; {REPORT}", runs)
+        bench("--offline --dry-download", f"import sys, lua2meta; lua2meta.main({argv!r}); {REPORT}", runs)
+
+
+if __name__ == "__main__":
+    main()
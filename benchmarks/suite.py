@@ -0,0 +1,263 @@
+"""Throughput and memory of lua2meta's hot paths, against local stand-ins for Steam, the request code endpoint and the CDN.
+
+usage: python benchmarks/suite.py [--runs N] [--quick] [--json PATH] [CASE ...]
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import fakes
+
+import lua2meta
+from lua2meta import bundle, downloader, lua_parser, vdf
+from lua2meta.logger import logger
+from lua2meta.metrics import Metrics
+from lua2meta.types import DepotInfo, Options
+
+MiB = 1 << 20
+
+
+def bench(name: str, fn: Callable[[], Any], runs: int, size: int = 0, setup: Callable[[], Any] | None = None) -> dict[str, Any]:
+    times: list[float] = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # a separate run, tracing allocations slows everything down
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = statistics.median(times)
+    result = {"name": name, "median": median, "min": min(times), "peak_memory": peak, "size": size}
+    throughput = f"{size / median / MiB:8.1f} MiB/s" if size else " " * 14
+    print(f"{name:<48} median {median * 1000:9.2f}ms  min {min(times) * 1000:9.2f}ms  {throughput}  peak {peak / MiB:7.2f} MiB")
+    return result
+
+
+def bench_parse(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    results = []
+    for depots in (100, 1000) if quick else (100, 1000, 10000):
+        src = fakes.make_lua(1000, fakes.make_catalog(1, depots, 0)[1000])
+        results.append(bench(f"parse lua, {depots} depots", lambda src=src: lua_parser.parse(src), runs, len(src)))
+    return results
+
+
+def bench_zip(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    results = []
+    cases = ((8, MiB), (32, MiB)) if quick else ((8, MiB), (32, MiB), (32, 8 * MiB))
+    for (depots, size), stored in itertools.product(cases, (False, True)):
+        catalog = fakes.make_catalog(1, depots, size)
+        name = f"zip_{depots}_{size}_{'stored' if stored else 'deflated'}"
+        bundle = tmp / f"{name}.zip"
+        fakes.make_bundle(bundle, 1000, catalog[1000], compression=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+        out_dir = tmp / name
+        out_dir.mkdir()
+
+        def ingest(bundle: Path = bundle, out_dir: Path = out_dir):
+            _, bundled = lua2meta.load_input_content(bundle)
+            manifests = {depot: candidates[-1] for depot, candidates in bundled.items()}
+            lua2meta.write_manifests(out_dir, manifests, None, None, Metrics())
+
+        results.append(
+            bench(f"zip ingestion, {depots} x {size // MiB} MiB, {'stored' if stored else 'deflated'}", ingest, runs, depots * size)
+        )
+    return results
+
+
+def bench_bundle(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    results = []
+    depots, size = (8, 4 * MiB) if quick else (32, 4 * MiB)
+    catalog = fakes.make_catalog(1, depots, size)
+    manifests: list[tuple[str, Path]] = []
+    for depot, (gid, size) in catalog[1000].items():
+        manifests.append((f"{depot}_{gid}.manifest", tmp / f"{depot}_{gid}.manifest"))
+        manifests[-1][1].write_bytes(fakes.manifest_bytes(depot, gid, size))
+
+    def write(workers: int):
+        with (tmp / "bundle.zip").open("wb") as file, bundle.BundleWriter(file, workers) as writer:
+            for name, path in manifests:
+                with path.open("rb") as src:
+                    writer.add(name, src)
+
+    for workers in dict.fromkeys((1, os.cpu_count() or 1)):
+        results.append(
+            bench(f"bundle, {depots} x {size // MiB} MiB, {workers} threads", lambda workers=workers: write(workers), runs, depots * size)
+        )
+    return results
+
+
+def bench_fetch(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    results = []
+    depots, size = (16, MiB) if quick else (64, MiB)
+    catalog = fakes.make_catalog(1, depots, size)
+    infos = {depot: DepotInfo(gid, size, None) for depot, (gid, size) in catalog[1000].items()}
+    fake = fakes.FakeSteam(catalog)
+    try:
+        with fakes.FakeSteamSession(fake) as session:
+            for jobs in (1, 8):
+                out_dir = tmp / f"fetch_{jobs}"
+                out_dir.mkdir()
+                options = Options(out_dir=out_dir, api_url=fake.api_url, jobs=jobs)
+                results.append(
+                    bench(
+                        f"fetch and decompress, {depots} x {size // MiB} MiB, {jobs} jobs",
+                        lambda options=options: lua2meta.fetch_manifests(session, options, Metrics(), None, options.out_dir, 1000, infos),
+                        runs,
+                        depots * size,
+                        session.request_codes.clear,
+                    )
+                )
+    finally:
+        fake.close()
+    return results
+
+
+def bench_vdf(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    results = []
+    catalog = fakes.make_catalog(1, 1000, 0)[1000]
+    metadata = fakes.FakeSteamClient({1000: catalog}).get_product_info([1000])["apps"][1000]
+    from lua2meta.network import parse_metadata
+
+    app_info, depot_infos, _ = parse_metadata(1000, metadata)
+    results.append(bench("write .acf, 1000 depots", lambda: vdf.write_acf(tmp, app_info, depot_infos, None), runs))
+
+    import vdf as vdf_module
+
+    config = tmp / "config.vdf"
+    existing = {str(depot): {"DecryptionKey": f"{depot:064x}"} for depot in range(10000, 15000)}
+    depot_keys = {depot: f"{depot:064x}" for depot in catalog}
+    for name, depots in (
+        ("new", existing),
+        ("unchanged", existing | {str(depot): {"DecryptionKey": key} for depot, key in depot_keys.items()}),
+    ):
+        template = vdf_module.dumps({"InstallConfigStore": {"Software": {"valve": {"Steam": {"depots": depots}}}}}, pretty=True)
+        results.append(
+            bench(
+                f"merge config.vdf, 1000 {name} keys",
+                lambda: lua2meta.update_config(config, depot_keys),
+                runs,
+                len(template),
+                lambda template=template: config.write_text(template),
+            )
+        )
+    return results
+
+
+def bench_downloader(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    # a downloader that only reports progress, what remains is the orchestration overhead
+    script = "import sys\nfor i in range(101): print(f'{i:.2f}% file', flush=True)\n"
+    depots = 8
+    commands = {depot: [sys.executable, "-c", script] for depot in range(depots)}
+    log_paths = {depot: tmp / f"download_{depot}.log" for depot in range(depots)}
+    return [
+        bench(
+            f"downloader orchestration, {depots} depots, 4 jobs",
+            lambda: downloader.run_parallel(commands, log_paths, 4, False, Metrics(), lambda depot: None),
+            max(1, runs // 2),
+        )
+    ]
+
+
+def bench_end_to_end(tmp: Path, runs: int, quick: bool) -> list[dict[str, Any]]:
+    apps, depots, size = (4, 8, MiB) if quick else (16, 8, MiB)
+    catalog = fakes.make_catalog(apps, depots, size)
+    paths = []
+    for appid, app_depots in catalog.items():
+        paths.append(tmp / f"app_{appid}.zip")
+        fakes.make_bundle(paths[-1], appid, app_depots, bundled=depots // 2)
+    fake = fakes.FakeSteam(catalog)
+    results = []
+    try:
+        with fakes.FakeSteamSession(fake) as session:
+            for pipeline in (False, True):
+                out_dir = tmp / f"end_to_end{'_pipeline' if pipeline else ''}"
+                out_dir.mkdir()
+                options = Options(out_dir=out_dir, api_url=fake.api_url, jobs=8, pipeline=pipeline, dry_download=True)
+
+                def run(options: Options = options):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        batch = lua2meta.process_batch(paths, options, session)
+                    assert all(result.status == 0 for result in batch), batch
+
+                results.append(
+                    bench(
+                        f"process batch, {apps} apps x {depots} depots{', pipelined' if pipeline else ''}",
+                        run,
+                        runs,
+                        apps * depots * size,
+                        session.request_codes.clear,
+                    )
+                )
+    finally:
+        fake.close()
+    return results
+
+
+CASES = {
+    "parse": bench_parse,
+    "zip": bench_zip,
+    "bundle": bench_bundle,
+    "fetch": bench_fetch,
+    "vdf": bench_vdf,
+    "downloader": bench_downloader,
+    "end-to-end": bench_end_to_end,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser("suite.py")
+    parser.add_argument("cases", nargs="*", metavar="CASE", help=f"cases to run, all by default: {', '.join(CASES)}")
+    parser.add_argument("--runs", metavar="N", type=int, default=5)
+    parser.add_argument("--quick", help="smaller inputs", action="store_true")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to a JSON file, to compare across releases", type=Path)
+    args = parser.parse_args()
+    if unknown := set(args.cases) - CASES.keys():
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+
+    logger.setLevel(logging.WARNING)
+    results: list[dict[str, Any]] = []
+    tmp = Path(tempfile.mkdtemp(prefix="lua2meta-bench-"))
+    try:
+        for name in args.cases or CASES:
+            case_dir = tmp / name
+            case_dir.mkdir()
+            results += CASES[name](case_dir, args.runs, args.quick)
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+            "quick": args.quick,
+            "results": results,
+        }
+        args.json.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
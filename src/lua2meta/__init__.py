@@ -1,24 +1,66 @@
 import errno
+import glob
+import json
 import os
 import re
 import shlex
 import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import zipfile
-from pathlib import Path
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from pathlib import Path, PurePosixPath
 from subprocess import CalledProcessError
+from typing import IO
 
-from steam.client import SteamClient
-from steam.client.cdn import CDNClient
+from lua2meta import delta, downloader, lua_parser, vdf
+from lua2meta.args import parse_args, parse_index_args, to_options
+from lua2meta.bundle import BundleWriter
+from lua2meta.cache import MetadataCache
+from lua2meta.index import ArchiveIndex
+from lua2meta.journal import DownloadJournal
+from lua2meta.logger import logger, print_line
+from lua2meta.metrics import Metrics
+from lua2meta.network import SteamSession, fetch_change_numbers, fetch_manifest, fetch_metadata
+from lua2meta.store import ManifestStore
+from lua2meta.types import (
+    AppInfo,
+    AppInput,
+    AppMetadata,
+    BundledManifests,
+    DepotInfo,
+    DepotInfos,
+    DepotKeys,
+    DepotManifests,
+    InputContent,
+    Manifest,
+    ManifestContent,
+    Options,
+    Result,
+    SharedDepots,
+    ZipMember,
+)
+from lua2meta.utils import (
+    atomic_open,
+    atomic_write_bytes,
+    copy_range,
+    dict_copyorder,
+    dict_intersect,
+    dict_subtract,
+    link_or_copy,
+)
 
-from lua2meta.logger import logger
-from lua2meta import lua_parser
-from lua2meta import vdf
-from lua2meta.args import args
-from lua2meta.network import fetch_manifest, fetch_metadata
-from lua2meta.types import DepotInfos, DepotKeys, DepotManifests, InputContent, Manifest
-from lua2meta.utils import dict_copyorder, dict_intersect
+__all__ = ["Metrics", "Options", "Result", "SteamSession", "main", "process", "process_batch"]
+
+# signature, versions, flags, method, time, date, crc, sizes, name and extra field lengths
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+# serve runs batches on several threads, each merging its keys into the same config .vdf
+CONFIG_LOCK = threading.Lock()
 
 
 def load_input_content(path: Path) -> InputContent:
@@ -28,180 +70,668 @@ def load_input_content(path: Path) -> InputContent:
         return InputContent(path.read_text(), {})
 
     with zipfile.ZipFile(path) as zip_file:
-        zip = zipfile.Path(zip_file)
-        lua_path: zipfile.Path | None = None
-        manifests: DepotManifests = {}
-        for child in (zip / path for path in zip_file.namelist()):
-            if child.is_file() and child.suffix == ".lua":
-                if lua_path:
-                    logger.warning(f'Additional "{lua_path.name}" skipped')
+        lua_info: zipfile.ZipInfo | None = None
+        manifests: BundledManifests = {}
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            child = PurePosixPath(info.filename)
+            if child.suffix == ".lua":
+                if lua_info:
+                    logger.warning(f'Additional "{child.name}" skipped')
                     continue
-                lua_path = child
-                logger.info(f'Found "{lua_path.name}"')
-            if child.is_file() and child.suffix == ".manifest":
+                lua_info = info
+                logger.info(f'Found "{child.name}"')
+            if child.suffix == ".manifest":
                 if not (match := re.fullmatch(r"(?P<depot_id>\d+)_(?P<gid>\d+)", child.stem)):
                     # binary vdf parsing is reportedly broken in steam module,
                     # which is probably abandoned, can only automate on filenames
                     logger.warning(f'Unrecognized manifest filename "{child.name}"')
                     continue
-                manifests[int(match.group("depot_id"))] = Manifest(int(match.group("gid")), child.read_bytes())
-        if not lua_path:
+                # only read once it is known to be needed, in write_manifests
+                manifest = Manifest(int(match.group("gid")), ZipMember(path, info.filename))
+                manifests.setdefault(int(match.group("depot_id")), []).append(manifest)
+        if not lua_info:
             raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), "*.lua")
-        return InputContent(lua_path.read_text(), manifests)
+        return InputContent(zip_file.read(lua_info).decode(), manifests)
 
 
 def fetch_manifests(
-    cdn_client: CDNClient,
+    session: SteamSession,
+    options: Options,
+    metrics: Metrics,
+    store: ManifestStore | None,
+    manifest_dir: Path,
     appid: int,
     manifest_infos: DepotInfos,
+    ready: Callable[[int, Manifest], None] | None = None,
 ) -> DepotManifests:
-    manifests: DepotManifests = {}
+    def fetch(depot: int, depot_info: DepotInfo) -> Manifest | None:
+        manifest = fetch_one(depot, depot_info)
+        if manifest is not None and ready:
+            ready(depot, manifest)
+        return manifest
 
-    for depot, depot_info in manifest_infos.items():
+    def fetch_one(depot: int, depot_info: DepotInfo) -> Manifest | None:
+        if store:
+            if manifest := store.get(depot, depot_info.gid):
+                logger.info(f"Manifest {depot_info.gid} for depot {depot} found in store")
+                metrics.count("manifest_store_hits")
+                return manifest
+            metrics.count("manifest_store_misses")
+        if not options.api_url:
+            return None
+        path = manifest_dir / f"{depot}_{depot_info.gid}.manifest"
         try:
-            manifest = fetch_manifest(cdn_client, appid, depot, depot_info.gid)
+            return fetch_manifest(session, options.api_url, metrics, appid, depot, depot_info.gid, path)
         except Exception as ex:
             logger.error(f"Failed to fetch manifest {depot_info.gid} for depot {depot}:")
             logger.error(ex)
-            continue
-        manifests[depot] = manifest
-    return manifests
+            return None
+
+    # request codes and downloads are mostly waiting on the network, overlap up to --jobs depots
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        fetched = executor.map(fetch, manifest_infos.keys(), manifest_infos.values())
+        return {depot: manifest for depot, manifest in zip(manifest_infos.keys(), fetched) if manifest is not None}
+
+
+def copy_zip_member(archive: Path, name: str, dst: IO[bytes]):
+    with zipfile.ZipFile(archive) as zip_file:
+        info = zip_file.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            with zip_file.open(info) as src:
+                shutil.copyfileobj(src, dst)
+            return
 
+    # stored as is, the data is copied straight from the archive instead of through zipfile's buffers
+    with archive.open("rb") as src:
+        src.seek(info.header_offset)
+        header = ZIP_LOCAL_HEADER.unpack(src.read(ZIP_LOCAL_HEADER.size))
+        if header[0] != b"PK\x03\x04":
+            raise zipfile.BadZipFile(f'Bad local file header for "{name}" in {archive}')
+        copy_range(src, info.header_offset + ZIP_LOCAL_HEADER.size + header[-2] + header[-1], info.file_size, dst)
 
-def write_manifests(manifests: DepotManifests):
+
+def write_manifests(
+    out_dir: Path,
+    manifests: DepotManifests,
+    store: ManifestStore | None,
+    index: ArchiveIndex | None,
+    metrics: Metrics,
+):
     for depot, (gid, content) in manifests.items():
-        (args.out_dir / f"{depot}_{gid}.manifest").write_bytes(content)
+        path = out_dir / f"{depot}_{gid}.manifest"
+        with metrics.phase("write", depot):
+            match content:
+                case Path():
+                    link_or_copy(content, path)
+                case ZipMember(archive, name):
+                    with atomic_open(path) as dst:
+                        copy_zip_member(archive, name, dst)
+            if store:
+                store.put(depot, gid, path)
+    if index:
+        index.put_manifests({(depot, gid): out_dir / f"{depot}_{gid}.manifest" for depot, (gid, _) in manifests.items()})
+
+
+@contextmanager
+def open_manifest(content: ManifestContent) -> Iterator[IO[bytes]]:
+    match content:
+        case Path():
+            with content.open("rb") as file:
+                yield file
+        case ZipMember(archive, name):
+            with zipfile.ZipFile(archive) as zip_file, zip_file.open(name) as file:
+                yield file
+
+
+def read_manifest(content: ManifestContent) -> bytes:
+    with open_manifest(content) as file:
+        return file.read()
+
+
+def compare_manifests(outdated: DepotManifests, manifests: DepotManifests, depot_keys: DepotKeys) -> dict[int, list[str]]:
+    changed: dict[int, list[str]] = {}
+    for depot, (old_gid, old_content) in outdated.items():
+        gid, content = manifests[depot]
+        try:
+            changed[depot] = delta.changed_files(read_manifest(old_content), read_manifest(content), depot_keys[depot])
+        except Exception as ex:
+            logger.warning(f"Failed to compare manifests {old_gid} and {gid} of depot {depot}, downloading all of it: {ex}")
+            continue
+        logger.info(f"{len(changed[depot])} files changed in depot {depot} from manifest {old_gid} to {gid}")
+    return changed
+
+
+def write_filelists(
+    out_dir: Path,
+    outdated: DepotManifests,
+    manifests: DepotManifests,
+    depot_keys: DepotKeys,
+    metrics: Metrics,
+) -> dict[int, Path | None]:
+    # the files changed in each outdated depot, None when nothing did. Depots that could not be compared are left out
+    with metrics.phase("delta"):
+        changed_files = compare_manifests(outdated, manifests, depot_keys)
+    filelists: dict[int, Path | None] = {}
+    for depot, changed in changed_files.items():
+        if not changed:
+            logger.info(f"Nothing to download for depot {depot}")
+            filelists[depot] = None
+            continue
+        path = out_dir / f"{depot}_{outdated[depot].gid}_{manifests[depot].gid}.filelist"
+        atomic_write_bytes(path, "".join(f"{name}\n" for name in changed).encode())
+        filelists[depot] = path
+    return filelists
+
+
+def format_keylist(depot_keys: DepotKeys) -> str:
+    return "\n".join(f"{depot};{key}" for depot, key in depot_keys.items())
+
 
+def write_keylist(out_dir: Path, appid: int, depot_keys: DepotKeys, index: ArchiveIndex | None):
+    (out_dir / f"{appid}_keys.txt").write_text(format_keylist(depot_keys))
+    if index:
+        index.put_keys(appid, depot_keys)
 
-def write_keylist(appid: int, depot_keys: DepotKeys):
-    s = "\n".join(f"{depot};{key}" for depot, key in depot_keys.items())
-    (args.out_dir / f"{appid}_keys.txt").write_text(s)
+
+def write_bundle(
+    path: Path,
+    appid: int,
+    depot_keys: DepotKeys,
+    manifests: DepotManifests,
+    app_info: AppInfo | None,
+    depot_infos: DepotInfos,
+    store: ManifestStore | None,
+    index: ArchiveIndex | None,
+):
+    # the same files as written to the output directory, in a fixed order
+    with atomic_open(path) as file, BundleWriter(file) as bundle:
+        bundle.add_bytes(f"{appid}_keys.txt", format_keylist(depot_keys).encode())
+        if app_info is not None:
+            bundle.add_bytes(f"appmanifest_{appid}.acf", vdf.dumps_acf(app_info, depot_infos).encode())
+        for depot, (gid, content) in sorted(manifests.items()):
+            with open_manifest(content) as src:
+                bundle.add(f"{depot}_{gid}.manifest", src)
+
+    if store:
+        # the fetched ones, those that came bundled with the input are not extracted only for the store
+        for depot, (gid, content) in manifests.items():
+            if isinstance(content, Path):
+                store.put(depot, gid, content)
+    if index:
+        index.put_keys(appid, depot_keys)
+        index.put_manifests({(depot, gid): path for depot, (gid, _) in manifests.items()})
+        if app_info is not None:
+            index.put_app(path, app_info, depot_infos)
 
 
-def update_config(depot_keys: DepotKeys):
-    backup_config = args.config.with_suffix(".bak.vdf")
+def update_config(config: Path, depot_keys: DepotKeys):
+    # all keys of a batch are merged at once. The previous file is kept as backup through a hardlink, and replaced atomically
+    with CONFIG_LOCK:
+        merge_config(config, depot_keys)
+
+
+def merge_config(config: Path, depot_keys: DepotKeys):
     try:
-        shutil.copyfile(args.config, backup_config)
+        merged = vdf.merge_config(config.read_text(encoding="utf-8"), depot_keys)
+    except Exception:
+        logger.error(f"Failed to read config .vdf file at {config}:")
+        raise
+    if merged is None:
+        logger.info(f"All {len(depot_keys)} depot keys already in {config}")
+        return
+
+    backup_config = config.with_suffix(".bak.vdf")
+    try:
+        link_or_copy(config, backup_config)
     except Exception:
         logger.error(f"Failed to create backup at {backup_config}, abort:")
         raise
     try:
-        vdf.write_config(depot_keys)
+        atomic_write_bytes(config, merged.encode("utf-8"))
     except Exception:
-        logger.error(f"Failed to update config .vdf file at {args.config}, backup available at {backup_config}:")
+        logger.error(f"Failed to update config .vdf file at {config}, backup available at {backup_config}:")
         raise
+    logger.info(f"Added depot keys to {config}")
+
+
+def link_depot(src_dir: Path, dst_dir: Path, manifest: bytes, depot_key: str):
+    # the files listed in the manifest, linked from the directory where another app downloaded the same depot
+    files = delta.manifest_files(manifest, bytes.fromhex(depot_key))
+    if missing := [name for name in files if not (src_dir / name).is_file()]:
+        raise FileNotFoundError(f"{len(missing)} files of the depot are missing from {src_dir}, such as {missing[0]}")
+    for name in files:
+        dst = dst_dir / name
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(src_dir / name, dst)
 
 
-def download(appid: int, manifests: DepotManifests, download_dir_name: Path):
-    download_dir = args.download_dir / download_dir_name
-
-    argv: list[str] = [""] * 12
-    argv[0] = str(args.downloader)
-    argv[1] = "-app"
-    argv[2] = str(appid)
-    argv[3] = "-depot"
-    argv[4] = "DEPOT PLACEHOLDER"
-    argv[5] = "-validate"
-    argv[6] = "-depotkeys"
-    argv[7] = str(args.out_dir / f"{appid}_keys.txt")
-    argv[8] = "-manifestfile"
-    argv[9] = "MANIFESTFILE PLACEHOLDER"
-    argv[10] = "-dir"
-    argv[11] = str(download_dir)
-    if args.downloader_args:
-        argv += shlex.split(args.downloader_args)
-
-    for depot, (gid, _) in manifests.items():
+class AppDownloads:
+    # the downloader command of each depot of an app, unless it is already downloaded or can be linked from another app of the batch
+    options: Options
+    metrics: Metrics
+    shared: SharedDepots
+    appid: int
+    depot_keys: DepotKeys
+    download_dir: Path
+    journal: DownloadJournal
+    gids: dict[int, int]
+    _argv: list[str]
+
+    def __init__(
+        self,
+        options: Options,
+        metrics: Metrics,
+        shared: SharedDepots,
+        appid: int,
+        depot_keys: DepotKeys,
+        download_dir_name: Path,
+    ):
+        assert options.download_dir
+        self.options = options
+        self.metrics = metrics
+        self.shared = shared
+        self.appid = appid
+        self.depot_keys = depot_keys
+        self.download_dir = options.download_dir / download_dir_name
+        self.journal = DownloadJournal(options.download_dir)
+        self.gids = {}
+
+        argv: list[str] = [""] * 12
+        argv[0] = str(options.downloader)
+        argv[1] = "-app"
+        argv[2] = str(appid)
+        argv[3] = "-depot"
+        argv[4] = "DEPOT PLACEHOLDER"
+        argv[5] = "-validate"
+        argv[6] = "-depotkeys"
+        argv[7] = str(options.out_dir / f"{appid}_keys.txt")
+        argv[8] = "-manifestfile"
+        argv[9] = "MANIFESTFILE PLACEHOLDER"
+        argv[10] = "-dir"
+        argv[11] = str(self.download_dir)
+        if options.downloader_args:
+            argv += shlex.split(options.downloader_args)
+        self._argv = argv
+
+    def command(self, depot: int, manifest: Manifest, filelist: Path | None) -> list[str] | None:
+        gid, content = manifest
+        self.gids[depot] = gid
+        if not self.options.redownload and self.journal.is_complete(self.appid, depot, gid):
+            logger.info(f"Depot {depot} already downloaded at manifest {gid}, skipped")
+            self.shared.downloads.setdefault((depot, gid), self.download_dir)
+            return None
+        if (source := self.shared.downloads.get((depot, gid))) is not None and not self.options.dry_download:
+            if source == self.download_dir:
+                logger.info(f"Depot {depot} already downloaded at manifest {gid} for another app, skipped")
+                self.complete(depot)
+                return None
+            try:
+                with self.metrics.phase("link", depot):
+                    link_depot(source, self.download_dir, read_manifest(content), self.depot_keys[depot])
+            except Exception as ex:
+                logger.warning(f"Failed to reuse depot {depot} from {source}, downloading it again: {ex}")
+            else:
+                logger.info(f"Depot {depot} at manifest {gid} linked from {source}")
+                self.metrics.count("depots_reused")
+                self.complete(depot)
+                return None
+
+        argv = self._argv.copy()
         argv[4] = str(depot)
-        argv[9] = str(args.out_dir / f"{depot}_{gid}.manifest")
-        print(*(f'"{arg}"' if " " in arg else arg for arg in argv))
-        if not args.dry_download:
-            download_dir.mkdir(exist_ok=True)
-            print("\\/\n")
+        argv[9] = str(self.options.out_dir / f"{depot}_{gid}.manifest")
+        if filelist:
+            # only the files changed since the previous manifest, which are new and need no validation
+            argv.remove("-validate")
+            argv += ["-filelist", str(filelist)]
+        # printed from several threads with --pipeline
+        print_line(" ".join(f'"{arg}"' if " " in arg else arg for arg in argv))
+        if not self.options.dry_download:
+            self.download_dir.mkdir(exist_ok=True)
+        return argv
+
+    def log_path(self, depot: int) -> Path:
+        assert self.options.download_dir
+        return self.options.download_dir / f"{self.appid}_{depot}.log"
+
+    def complete(self, depot: int):
+        self.journal.complete(self.appid, depot, self.gids[depot])
+        self.shared.downloads[depot, self.gids[depot]] = self.download_dir
+
+
+def check_returncodes(commands: dict[int, list[str]], returncodes: dict[int, int]):
+    logger.info("Downloader status per depot:")
+    for depot in commands:
+        logger.info(f"  {depot}: {returncodes.get(depot, 'skipped')}")
+    for depot, returncode in returncodes.items():
+        if returncode:
+            raise CalledProcessError(returncode, commands[depot])
+
+
+def download(
+    options: Options,
+    metrics: Metrics,
+    shared: SharedDepots,
+    appid: int,
+    depot_keys: DepotKeys,
+    manifests: DepotManifests,
+    download_dir_name: Path,
+    filelists: dict[int, Path | None],
+):
+    downloads = AppDownloads(options, metrics, shared, appid, depot_keys, download_dir_name)
+    commands: dict[int, list[str]] = {}
+    for depot, manifest in manifests.items():
+        if (argv := downloads.command(depot, manifest, filelists.get(depot))) is None or options.dry_download:
+            continue
+        if options.download_jobs > 1:
+            commands[depot] = argv
+            continue
+        print("\\/\n")
+        with metrics.phase("downloader", depot):
             subprocess.run(argv, check=True)
+        downloads.complete(depot)
 
+    if commands:
+        log_paths = {depot: downloads.log_path(depot) for depot in commands}
+        returncodes = downloader.run_parallel(
+            commands,
+            log_paths,
+            options.download_jobs,
+            options.keep_going,
+            metrics,
+            downloads.complete,
+        )
+        check_returncodes(commands, returncodes)
 
-def main():
-    if not args.out_dir.is_dir():
-        logger.error(OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(args.out_dir)))
-        return 1
-    if args.acf_dir is None:
-        args.acf_dir = args.out_dir
-    if not args.acf_dir.is_dir():
-        logger.error(OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(args.out_dir)))
-        return 1
-    if args.config and not args.config.is_file():
-        logger.error(OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(args.config)))
-        return 1
-    if args.download_dir is None:
-        args.download_dir = args.out_dir
-    if not args.download_dir.is_dir():
-        logger.error(OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(args.out_dir)))
-        return 1
 
-    if args.api_url:
-        # validate api_url template
+class DepotPipeline:
+    # each depot of an app is written and starts downloading as soon as its manifest is available, from the threads fetching
+    # the others. Failures are logged and turned into the app's status by wait(), the other depots carry on
+    options: Options
+    metrics: Metrics
+    store: ManifestStore | None
+    shared: SharedDepots
+    outdated: DepotManifests
+    downloads: AppDownloads
+    pool: downloader.DownloaderPool
+    handled: set[int]
+    written: DepotManifests
+    commands: dict[int, list[str]]
+    status: int
+    _keylist_written: bool
+
+    def __init__(
+        self,
+        options: Options,
+        metrics: Metrics,
+        store: ManifestStore | None,
+        index: ArchiveIndex | None,
+        shared: SharedDepots,
+        appid: int,
+        depot_keys: DepotKeys,
+        outdated: DepotManifests,
+        download_dir_name: Path,
+    ):
+        self.options = options
+        self.metrics = metrics
+        self.store = store
+        self.shared = shared
+        self.outdated = outdated
+        self.downloads = AppDownloads(options, metrics, shared, appid, depot_keys, download_dir_name)
+        self.handled = set()
+        self.written = {}
+        self.commands = {}
+        self.status = 0
+        self._keylist_written = False
         try:
-            args.api_url.format(appid=0, depotid=1, manifestid=2)
-        except KeyError as ex:
-            logger.error(f"Invalid api endpoint template, used unknown placeholder: {ex.args[0]}")
-            return 1
-        except ValueError:
-            logger.error('Invalid api endpoint template, try "--help" for more information')
-            return 1
+            # needed by every downloader
+            write_keylist(options.out_dir, appid, depot_keys, index)
+            self._keylist_written = True
+        except Exception as ex:
+            logger.error(f"Failed to write output to {options.out_dir.absolute()}:")
+            logger.error(ex)
+            self.status = 4
+        self.pool = downloader.DownloaderPool(options.download_jobs, options.keep_going, metrics, self.downloads.complete)
+
+    def ready(self, depot: int, manifest: Manifest):
+        self.handled.add(depot)
+        if not self._keylist_written:
+            return
+        try:
+            if (depot, manifest.gid) not in self.shared.manifests:
+                write_manifests(self.options.out_dir, {depot: manifest}, self.store, None, self.metrics)
+                self.written[depot] = manifest
+            filelists: dict[int, Path | None] = {}
+            if depot in self.outdated:
+                filelists = write_filelists(
+                    self.options.out_dir, {depot: self.outdated[depot]}, {depot: manifest}, self.downloads.depot_keys, self.metrics
+                )
+                if depot in filelists and filelists[depot] is None:
+                    return
+            if (argv := self.downloads.command(depot, manifest, filelists.get(depot))) is None or self.options.dry_download:
+                return
+        except Exception as ex:
+            logger.error(f"Failed to write depot {depot} to {self.options.out_dir.absolute()}:")
+            logger.error(ex)
+            self.status = 4
+            return
+        self.commands[depot] = argv
+        self.pool.submit(depot, argv, self.downloads.log_path(depot))
+
+    def wait(self) -> int:
+        try:
+            returncodes = self.pool.wait()
+            if self.commands:
+                check_returncodes(self.commands, returncodes)
+        except CalledProcessError as ex:
+            logger.error(f"\nDownloader terminated with a non-zero status {ex.returncode}")
+            return 6
+        except Exception as ex:
+            logger.error(f"Failed to download in {self.downloads.download_dir.absolute()}:")
+            logger.error(ex)
+        return self.status
+
+
+def expand_inputs(paths: list[Path]) -> list[Path]:
+    inputs: list[Path] = []
+    for path in paths:
+        if str(path) == "-" or path.is_file():
+            inputs.append(path)
+        elif path.is_dir():
+            inputs += sorted(child for child in path.iterdir() if child.is_file() and child.suffix in (".lua", ".zip"))
+        elif glob.has_magic(str(path)):
+            if not (matches := sorted(Path(match) for match in glob.glob(str(path)))):
+                logger.warning(f'No input matches "{path}"')
+            inputs += (match for match in matches if match.is_file())
+        else:
+            inputs.append(path)  # let loading report the error
+    return list(dict.fromkeys(inputs))
+
 
+def load_app_input(path: Path, options: Options) -> AppInput | int:
     try:
-        lua_src, manifests = load_input_content(args.lua)
+        lua_src, bundled = load_input_content(path)
     except Exception as ex:
         logger.error("Attempting to open lua source file resulted in the following error:")
         logger.error(ex)
         return 2
 
     try:
-        appid, depot_keys = lua_parser.parse(lua_src)
+        appid, depot_keys, lua_manifests = lua_parser.parse(lua_src, options.appid)
     except Exception as ex:
         logger.error("Attempting to parse lua source file resulted in the following error:")
         logger.error(ex)
         return 2
 
-    if args.depots:
-        depot_keys: DepotKeys = {depot: depot_keys[depot] for depot in args.depots if depot in depot_keys}
-    manifests = dict_intersect(manifests, depot_keys)
+    if options.depots:
+        depot_keys: DepotKeys = {depot: depot_keys[depot] for depot in options.depots if depot in depot_keys}
+    lua_manifests = dict_intersect(lua_manifests, depot_keys)
+    manifests: DepotManifests = {}
+    for depot, candidates in dict_intersect(bundled, depot_keys).items():
+        # the one setManifestid() names, otherwise the last one in the archive
+        if depot not in lua_manifests:
+            manifests[depot] = candidates[-1]
+        elif matching := [manifest for manifest in candidates if manifest.gid == lua_manifests[depot].gid]:
+            manifests[depot] = matching[0]
+        else:
+            manifests[depot] = candidates[-1]
+            logger.warning(
+                f"Bundled manifest {candidates[-1].gid} for depot {depot} does not match {lua_manifests[depot].gid} from setManifestid()"
+            )
+    return AppInput(path, appid, depot_keys, manifests, lua_manifests)
 
-    if not args.offline:
-        client = SteamClient()
-        client.anonymous_login()
-        logger.info("Logged in anonymously")
 
-        try:
-            app_info, depot_infos = fetch_metadata(client, appid)
-        except Exception:
+def load_metadata(session: SteamSession, options: Options, metrics: Metrics, appids: list[int]) -> dict[int, AppMetadata]:
+    def fetch(appids: list[int]) -> dict[int, AppMetadata]:
+        with metrics.phase("login"):
+            session.login()
+        with metrics.phase("product_info"):
+            return fetch_metadata(session, appids)
+
+    if not options.cache_dir:
+        return fetch(appids)
+
+    try:
+        cache = MetadataCache(options.cache_dir, options.cache_ttl)
+    except Exception as ex:
+        logger.warning(f"Product info cache unavailable: {ex}")
+        return fetch(appids)
+
+    metadata: dict[int, AppMetadata] = {}
+    expired: dict[int, AppMetadata] = {}
+    for appid in appids:
+        if (entry := cache.load(appid)) is None:
+            continue
+        app_metadata, fresh = entry
+        if fresh:
+            metadata[appid] = app_metadata
+        elif options.cache_validate and app_metadata.change_number is not None:
+            expired[appid] = app_metadata
+
+    if expired:
+        with metrics.phase("login"):
+            session.login()
+        with metrics.phase("change_numbers"):
+            change_numbers = fetch_change_numbers(session, expired.keys())
+        for appid, app_metadata in expired.items():
+            if change_numbers.get(appid) == app_metadata.change_number:
+                cache.touch(appid)
+                metadata[appid] = app_metadata
+    logger.info(f"Product info of {len(metadata)}/{len(appids)} apps loaded from cache")
+    metrics.count("metadata_cache_hits", len(metadata))
+    metrics.count("metadata_cache_misses", len(appids) - len(metadata))
+
+    if missing := [appid for appid in appids if appid not in metadata]:
+        fetched = fetch(missing)
+        for app_metadata in fetched.values():
+            try:
+                cache.store(app_metadata)
+            except Exception as ex:
+                logger.warning(f"Failed to cache product info of app {app_metadata.app_info.appid}: {ex}")
+        metadata |= fetched
+    return metadata
+
+
+def process_app(
+    session: SteamSession,
+    options: Options,
+    metrics: Metrics,
+    store: ManifestStore | None,
+    index: ArchiveIndex | None,
+    manifest_dir: Path,
+    app_input: AppInput,
+    metadata: AppMetadata | None,
+    config_keys: DepotKeys,
+    shared: SharedDepots,
+) -> int:
+    _, appid, depot_keys, manifests, lua_manifests = app_input
+    app_info: AppInfo | None = None
+    depot_infos: DepotInfos = {}
+    outdated: DepotManifests = {}  # bundled manifests replaced with --update, compared with --delta
+    pipeline: DepotPipeline | None = None
+
+    if options.offline:
+        if store:
+            for depot, lua_manifest in lua_manifests.items():
+                if depot in manifests and manifests[depot].gid == lua_manifest.gid:
+                    continue
+                if manifest := store.get(depot, lua_manifest.gid):
+                    logger.info(f"Manifest {lua_manifest.gid} for depot {depot} found in store")
+                    metrics.count("manifest_store_hits")
+                    manifests[depot] = manifest
+                else:
+                    metrics.count("manifest_store_misses")
+
+        if lua_manifests:
+            # enough for Steam to recognize the installed depots, name and build id are filled in once it updates the app
+            app_info = AppInfo(appid, f"App {appid}", Path(str(appid)), 0)
+            for depot, (gid, _) in manifests.items():
+                size = lua_manifests[depot].size if depot in lua_manifests and lua_manifests[depot].gid == gid else 0
+                depot_infos[depot] = DepotInfo(gid, size, None)
+    else:
+        if metadata is None:
             logger.error("Failed fetch metadata from Steam")
             return 3
+        app_info, depot_infos, _ = metadata
 
         for depot in depot_keys.keys() - depot_infos.keys():
             logger.warning(f"Unknown depot {depot} will be skipped")
+        for depot, lua_manifest in dict_intersect(lua_manifests, depot_infos).items():
+            if lua_manifest.gid != depot_infos[depot].gid:
+                logger.info(
+                    f"Steam has manifest {depot_infos[depot].gid} for depot {depot}, newer than {lua_manifest.gid} from setManifestid()"
+                )
         depot_keys = dict_intersect(depot_keys, depot_infos)
         manifests = dict_intersect(manifests, depot_infos)
 
-        if args.api_url:
+        if index:
+            index.put_latest(appid, dict_intersect(depot_infos, depot_keys))
+            if options.skip_indexed and index.is_current(appid, app_info.build_id, depot_keys, depot_infos):
+                logger.info(f"App {appid} is up to date in the index, skipped")
+                metrics.count("apps_skipped")
+                if options.config:
+                    config_keys |= depot_keys
+                return 0
+
+        if options.api_url or store:
             remote_manifest_gids = depot_keys.keys() - manifests.keys()
 
-            if args.update:
+            if options.update:
                 upgradable_manifest_gids = {depot for depot in manifests.keys() if manifests[depot].gid != depot_infos[depot].gid}
                 for depot in upgradable_manifest_gids:
                     logger.info(f"Outdated manifest for depot {depot}")
                 remote_manifest_gids |= upgradable_manifest_gids
+                if options.delta:
+                    outdated = dict_intersect(manifests, upgradable_manifest_gids)
 
-            cdn_client = CDNClient(client)
-            fetched_manifests = fetch_manifests(
-                cdn_client,
-                appid,
-                dict_intersect(depot_infos, remote_manifest_gids),
-            )
+            # obtained by an earlier app of the batch
+            reused_manifests = {
+                depot: shared.manifests[depot, depot_infos[depot].gid]
+                for depot in remote_manifest_gids
+                if (depot, depot_infos[depot].gid) in shared.manifests
+            }
+            if reused_manifests:
+                metrics.count("manifests_reused", len(reused_manifests))
+            if options.pipeline:
+                pipeline = DepotPipeline(options, metrics, store, index, shared, appid, depot_keys, outdated, app_info.install_dir)
+                for depot, manifest in (dict_subtract(manifests, remote_manifest_gids) | reused_manifests).items():
+                    pipeline.ready(depot, manifest)
+            with metrics.phase("manifests"):
+                fetched_manifests = reused_manifests | fetch_manifests(
+                    session,
+                    options,
+                    metrics,
+                    store,
+                    manifest_dir,
+                    appid,
+                    dict_intersect(depot_infos, remote_manifest_gids - reused_manifests.keys()),
+                    pipeline.ready if pipeline else None,
+                )
             for depot in remote_manifest_gids - fetched_manifests.keys():
                 logger.error(f"Failed to download manifest file for depot {depot}")
             manifests |= fetched_manifests  # breaks ordering
+            outdated = dict_intersect(outdated, fetched_manifests)
 
         depot_infos = dict_intersect(depot_infos, manifests)
         manifests = dict_copyorder(manifests, depot_infos)
@@ -209,45 +739,320 @@ def main():
     if lost_manifests := depot_keys.keys() - manifests.keys():
         logger.error("Missing necessary manifests for the following depots:")
         logger.error(", ".join(map(str, lost_manifests)))
+        if pipeline:
+            pipeline.wait()
         return 3
 
+    if options.bundle:
+        bundle_path = options.out_dir / f"{appid}.zip"
+        try:
+            with metrics.phase("bundle"):
+                write_bundle(bundle_path, appid, depot_keys, manifests, app_info, depot_infos, store, index)
+        except Exception as ex:
+            logger.error(f"Failed to write bundle {bundle_path.absolute()}:")
+            logger.error(ex)
+            return 4
+        logger.info(f"Wrote {bundle_path}")
+        shared.manifests.update(((depot, manifest.gid), manifest) for depot, manifest in manifests.items())
+        if not options.offline and options.config:
+            config_keys |= depot_keys
+        return 0
+
+    download_dir_name = Path(str(appid)) if app_info is None else app_info.install_dir
+    if options.pipeline:
+        if pipeline is None:
+            pipeline = DepotPipeline(options, metrics, store, index, shared, appid, depot_keys, outdated, download_dir_name)
+        for depot, manifest in manifests.items():
+            if depot not in pipeline.handled:
+                pipeline.ready(depot, manifest)
+        return finish_pipeline(options, metrics, index, pipeline, app_info, depot_infos, depot_keys, config_keys)
+
+    unwritten = {depot: manifest for depot, manifest in manifests.items() if (depot, manifest.gid) not in shared.manifests}
     try:
-        write_keylist(appid, depot_keys)
-        write_manifests(manifests)
+        with metrics.phase("write"):
+            write_keylist(options.out_dir, appid, depot_keys, index)
+            write_manifests(options.out_dir, unwritten, store, index, metrics)
     except Exception as ex:
-        logger.error(f"Failed to write output to {args.out_dir.absolute()}:")
+        logger.error(f"Failed to write output to {options.out_dir.absolute()}:")
         logger.error(ex)
         return 4
+    shared.manifests.update(
+        ((depot, gid), Manifest(gid, options.out_dir / f"{depot}_{gid}.manifest")) for depot, (gid, _) in unwritten.items()
+    )
 
-    if not args.offline:
+    if app_info is not None:
         try:
-            vdf.write_acf(app_info, depot_infos)  # pyright: ignore[reportPossiblyUnboundVariable]
+            with metrics.phase("acf"):
+                vdf.write_acf(options.acf_dir or options.out_dir, app_info, depot_infos, index)
         except Exception as ex:
-            logger.error(f"Failed to write .acf file to {args.acf_dir}:")
+            logger.error(f"Failed to write .acf file to {options.acf_dir}:")
+            logger.error(ex)
+            return 4
+
+    if not options.offline and options.config:
+        config_keys |= depot_keys
+
+    filelists: dict[int, Path | None] = {}
+    download_manifests = manifests
+    if outdated:
+        try:
+            filelists = write_filelists(options.out_dir, outdated, manifests, depot_keys, metrics)
+            download_manifests = dict_subtract(manifests, {depot for depot, filelist in filelists.items() if filelist is None})
+        except Exception as ex:
+            logger.error(f"Failed to write file list to {options.out_dir.absolute()}:")
             logger.error(ex)
             return 4
-        if args.config:
-            try:
-                update_config(depot_keys)
-            except Exception as ex:
-                logger.error("Try updating the config .vdf file manually")
-                logger.error(ex)
 
     try:
-        download(
-            appid,
-            manifests,
-            Path(str(appid)) if args.offline else app_info.install_dir,  # pyright: ignore[reportPossiblyUnboundVariable]
-        )
+        with metrics.phase("download"):
+            download(
+                options,
+                metrics,
+                shared,
+                appid,
+                depot_keys,
+                download_manifests,
+                download_dir_name,
+                filelists,
+            )
     except CalledProcessError as ex:
         logger.error(f"\nDownloader terminated with a non-zero status {ex.returncode}")
         return 6
     except Exception as ex:
-        logger.error(f"Failed to download in {args.download_dir.absolute()}:")
+        logger.error(f"Failed to download in {(options.download_dir or options.out_dir).absolute()}:")
         logger.error(ex)
 
     return 0
 
 
+def finish_pipeline(
+    options: Options,
+    metrics: Metrics,
+    index: ArchiveIndex | None,
+    pipeline: DepotPipeline,
+    app_info: AppInfo | None,
+    depot_infos: DepotInfos,
+    depot_keys: DepotKeys,
+    config_keys: DepotKeys,
+) -> int:
+    # all manifests are in, what remains of the app are the outputs covering all of its depots
+    out_dir = options.out_dir
+    if index:
+        index.put_manifests({(depot, gid): out_dir / f"{depot}_{gid}.manifest" for depot, (gid, _) in pipeline.written.items()})
+    pipeline.shared.manifests.update(
+        ((depot, gid), Manifest(gid, out_dir / f"{depot}_{gid}.manifest")) for depot, (gid, _) in pipeline.written.items()
+    )
+
+    status = 0
+    if app_info is not None:
+        try:
+            with metrics.phase("acf"):
+                vdf.write_acf(options.acf_dir or out_dir, app_info, depot_infos, index)
+        except Exception as ex:
+            logger.error(f"Failed to write .acf file to {options.acf_dir}:")
+            logger.error(ex)
+            status = 4
+    if not options.offline and options.config:
+        config_keys |= depot_keys
+
+    with metrics.phase("download"):
+        return pipeline.wait() or status
+
+
+def check_options(options: Options) -> Options:
+    if options.bundle and (options.acf_dir not in (None, options.out_dir) or options.download_dir not in (None, options.out_dir)):
+        raise ValueError("--bundle writes everything to the output directory, it cannot be used with --acf-dir or --download-dir")
+    if options.bundle and (options.delta or options.dry_download):
+        raise ValueError("--bundle downloads nothing, it cannot be used with --delta or --dry-download")
+    if options.bundle and options.pipeline:
+        raise ValueError("--bundle downloads nothing, there is nothing to pipeline")
+    acf_dir = options.acf_dir or options.out_dir
+    download_dir = options.download_dir or options.out_dir
+    options = options._replace(acf_dir=acf_dir, download_dir=download_dir)
+    for path in (options.out_dir, acf_dir, download_dir):
+        if not path.is_dir():
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(path))
+    if options.config and not options.config.is_file():
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(options.config))
+
+    if options.delta and not options.update:
+        raise ValueError("--delta can only be used with --update")
+    if options.skip_indexed and not options.index_path:
+        raise ValueError("--skip-indexed can only be used with --index")
+    if options.skip_indexed and options.offline:
+        raise ValueError("--skip-indexed compares the index with Steam, it cannot be used with --offline")
+    if options.jobs < 1:
+        raise ValueError(f"Invalid number of jobs {options.jobs}, must be at least 1")
+    if options.download_jobs < 1:
+        raise ValueError(f"Invalid number of download jobs {options.download_jobs}, must be at least 1")
+    if options.api_rate is not None and options.api_rate <= 0:
+        raise ValueError(f"Invalid api rate {options.api_rate}, must be positive")
+
+    if options.api_url:
+        # validate api_url template
+        try:
+            options.api_url.format(appid=0, depotid=1, manifestid=2)
+        except KeyError as ex:
+            raise ValueError(f"Invalid api endpoint template, used unknown placeholder: {ex.args[0]}") from None
+        except ValueError:
+            raise ValueError('Invalid api endpoint template, try "--help" for more information') from None
+    return options
+
+
+def process_batch(
+    paths: Sequence[Path],
+    options: Options,
+    session: SteamSession | None = None,
+    metrics: Metrics | None = None,
+) -> list[Result]:
+    options = check_options(options)
+    metrics = Metrics() if metrics is None else metrics
+    store = ManifestStore(options.manifest_store) if options.manifest_store else None
+
+    statuses: dict[Path, int] = {}
+    app_inputs: list[AppInput] = []
+    with metrics.phase("load"):
+        for path in paths:
+            if len(paths) > 1:
+                logger.info(f'Loading "{path}"')
+            app_input = load_app_input(path, options)
+            if isinstance(app_input, int):
+                statuses[path] = app_input
+            else:
+                app_inputs.append(app_input)
+
+    config_keys: DepotKeys = {}
+    # depots shared between apps, such as redistributables, are fetched and downloaded once per batch
+    shared = SharedDepots({}, {})
+    with (
+        SteamSession(options.api_rate) if session is None else nullcontext(session) as steam,
+        ArchiveIndex(options.index_path) if options.index_path else nullcontext() as index,
+        # fetched manifests only go into bundles, they are kept until the end of the batch for the apps that share them
+        tempfile.TemporaryDirectory(prefix=".lua2meta-", dir=options.out_dir) if options.bundle else nullcontext() as staging_dir,
+    ):
+        manifest_dir = Path(staging_dir) if staging_dir else options.out_dir
+        metadata: dict[int, AppMetadata] = {}
+        if not options.offline and app_inputs:
+            with metrics.phase("metadata"):
+                metadata = load_metadata(steam, options, metrics, list(dict.fromkeys(app_input.appid for app_input in app_inputs)))
+
+        for app_input in app_inputs:
+            if len(paths) > 1:
+                logger.info(f'Processing app {app_input.appid} from "{app_input.path}"')
+            statuses[app_input.path] = process_app(
+                steam, options, metrics, store, index, manifest_dir, app_input, metadata.get(app_input.appid), config_keys, shared
+            )
+
+    if options.config and config_keys:
+        try:
+            with metrics.phase("config"):
+                update_config(options.config, config_keys)
+        except Exception as ex:
+            logger.error("Try updating the config .vdf file manually")
+            logger.error(ex)
+
+    appids = {app_input.path: app_input.appid for app_input in app_inputs}
+    return [Result(path, appids.get(path), statuses[path]) for path in paths]
+
+
+def process(path: Path, options: Options, session: SteamSession | None = None, metrics: Metrics | None = None) -> Result:
+    return process_batch([path], options, session, metrics)[0]
+
+
+def write_metrics(path: Path, metrics: Metrics, format: str):
+    report = metrics.prometheus() if format == "prometheus" else json.dumps(metrics.report(), indent=2)
+    atomic_write_bytes(path, report.encode())
+
+
+def query_index(argv: Sequence[str]) -> int:
+    args = parse_index_args(argv)
+    if not args.index.is_file():
+        logger.error(f"Index {args.index} does not exist")
+        return 1
+    try:
+        with ArchiveIndex(args.index) as index:
+            rows = getattr(index, args.query)(args.appids)
+    except Exception as ex:
+        logger.error(f"Failed to query index {args.index}:")
+        logger.error(ex)
+        return 1
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for row in rows:
+            print(*("" if value is None else value for value in row.values()), sep="\t")
+    return 0
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        from lua2meta import server
+
+        return server.main(argv[1:])
+    if argv[:1] == ["index"]:
+        return query_index(argv[1:])
+
+    args = parse_args(argv)
+    try:
+        options = check_options(to_options(args))
+    except (OSError, ValueError) as ex:
+        logger.error(ex)
+        return 1
+
+    metrics = Metrics()
+
+    def save_metrics():
+        if args.metrics:
+            try:
+                write_metrics(args.metrics, metrics, args.metrics_format)
+            except OSError as ex:
+                logger.error(f"Failed to write metrics to {args.metrics}: {ex}")
+
+    if args.watch:
+        if args.lua:
+            logger.error("--watch cannot be used along with input paths")
+            return 1
+        if options.appid is not None:
+            logger.error("--appid can only be used with a single input")
+            return 1
+        if not args.watch.is_dir():
+            logger.error(f'Watched directory "{args.watch}" does not exist')
+            return 1
+        if options.bundle and options.out_dir.resolve() == args.watch.resolve():
+            # each bundle would be picked up as a new input
+            logger.error("--bundle cannot write to the watched directory, use -o to write the bundles elsewhere")
+            return 1
+        from lua2meta import watch
+
+        return watch.watch(args.watch, options, args.debounce, metrics, save_metrics)
+
+    paths = expand_inputs(args.lua)
+    if not paths:
+        logger.error("No .lua or .zip input found")
+        return 2
+    if options.appid is not None and len(paths) > 1:
+        logger.error("--appid can only be used with a single input")
+        return 1
+
+    try:
+        results = process_batch(paths, options, metrics=metrics)
+    except Exception as ex:
+        logger.error(ex)
+        return 1
+    finally:
+        save_metrics()
+
+    if len(results) > 1:
+        logger.info("Summary:")
+        for result in results:
+            appid = "no app" if result.appid is None else f"app {result.appid}"
+            logger.info(f'  {result.status}  {appid} from "{result.path}"')
+        logger.info(f"{sum(result.status == 0 for result in results)}/{len(results)} inputs succeeded")
+
+    return max(result.status for result in results)
+
+
 if __name__ == "__main__":
     main()
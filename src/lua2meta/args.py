@@ -1,26 +1,23 @@
 import argparse
+from collections.abc import Sequence
 from dataclasses import dataclass
 from pathlib import Path
 from typing import cast
 
-__all__ = ["args"]
+from lua2meta.types import Options
 
-_parser = argparse.ArgumentParser("lua2meta")
+__all__ = ["Args", "IndexArgs", "ServeArgs", "parse_args", "parse_index_args", "parse_serve_args", "to_options"]
 
-_parser.add_argument(
-    "lua",
-    metavar="PATH",
-    help="path to the .lua file or .zip with lua and .manifest s",
-    type=Path,
-)
+# options shared by single runs and the jobs of "lua2meta serve"
+_options = argparse.ArgumentParser(add_help=False)
 
-_parser.add_argument(
+_options.add_argument(
     "--appid",
     metavar="APPID",
     help="provide the appid and avoid guessing from the .lua file",
     type=int,
 )
-_parser.add_argument(
+_options.add_argument(
     "--depots",
     nargs="+",
     metavar="DEPOT-ID",
@@ -28,7 +25,7 @@ _parser.add_argument(
     type=int,
 )
 
-_parser.add_argument(
+_options.add_argument(
     "-o",
     "--out-dir",
     metavar="PATH",
@@ -37,7 +34,7 @@ _parser.add_argument(
     type=Path,
 )
 
-_parser.add_argument(
+_options.add_argument(
     "--acf-dir",
     metavar="PATH",
     help="override the directory where the .acf file will be written to",
@@ -45,28 +42,101 @@ _parser.add_argument(
 )
 
 
-_parser.add_argument(
+_options.add_argument(
+    "--bundle",
+    help="write one .zip per app to the output directory instead of the _keys.txt, .manifest and .acf files, and download nothing. "
+    "Bundles of the same outputs are identical to the byte",
+    action="store_true",
+)
+
+_options.add_argument(
     "-f",
     "--offline",
-    help="do not fetch from network. No .acf will be generated",
+    help="do not fetch from network. The .acf is only generated from setManifestid() calls in the .lua file, with a placeholder name and build id",
     action="store_true",
 )
 
-_parser.add_argument(
+_options.add_argument(
     "-u",
     "--update",
     help="prefer cdn manifests over bundled, in case of gid mismatch",
     action="store_true",
 )
 
-_parser.add_argument(
+_options.add_argument(
+    "--delta",
+    help="with --update, only download the files that changed from the outdated bundled manifest, without -validate. "
+    "The download directory must hold the outdated version",
+    action="store_true",
+)
+
+_options.add_argument(
+    "--cache-dir",
+    metavar="PATH",
+    help="cache Steam product info in the given directory, so that runs with fresh entries skip the Steam login",
+    type=Path,
+)
+
+_options.add_argument(
+    "--cache-ttl",
+    metavar="SECONDS",
+    help="age after which cached product info is fetched again. Default: 3600",
+    default=3600,
+    type=float,
+)
+
+_options.add_argument(
+    "--cache-validate",
+    help="check expired cache entries against the Steam change number and keep those that are unchanged",
+    action="store_true",
+)
+
+_options.add_argument(
     "-a",
     "--api-url",
     metavar="TEMPLATE",
     help='API endpoint from which manifest request codes are obtained. Python format string with "appid", "manifestid", "depotid"',
 )
 
-_parser.add_argument(
+_options.add_argument(
+    "--api-rate",
+    metavar="N",
+    help="maximum requests per second to the --api-url endpoint. Unlimited by default, until the endpoint answers 429: "
+    "requests then slow down, and speed up again while they succeed",
+    type=float,
+)
+
+_options.add_argument(
+    "--manifest-store",
+    metavar="PATH",
+    help="directory shared between runs where manifests are kept by depot and gid, and looked up before fetching from the cdn",
+    type=Path,
+)
+
+_options.add_argument(
+    "--index",
+    dest="index_path",
+    metavar="PATH",
+    help='SQLite database, created if missing, where the apps, depots, manifests and keys written are recorded. See "lua2meta index --help"',
+    type=Path,
+)
+
+_options.add_argument(
+    "--skip-indexed",
+    help="with --index, skip apps whose build, manifests and keys in the index match Steam, without fetching or writing anything",
+    action="store_true",
+)
+
+_options.add_argument(
+    "-j",
+    "--jobs",
+    metavar="N",
+    help="number of manifests to fetch concurrently",
+    default=1,
+    type=int,
+)
+
+_options.add_argument(
     "-c",
     "--config",
     metavar="PATH",
@@ -74,7 +144,7 @@ _parser.add_argument(
     type=Path,
 )
 
-_parser.add_argument(
+_options.add_argument(
     "-d",
     "--download-dir",
     metavar="PATH",
@@ -82,14 +152,41 @@ _parser.add_argument(
     type=Path,
 )
 
-_parser.add_argument(
+_options.add_argument(
     "-D",
     "--dry-download",
     help="print a CLI command instead of running the downloader",
     action="store_true",
 )
 
-_parser.add_argument(
+_options.add_argument(
+    "--download-jobs",
+    metavar="N",
+    help="number of depots to download concurrently, each with its own log in the download directory",
+    default=1,
+    type=int,
+)
+
+_options.add_argument(
+    "--pipeline",
+    help="write each depot and start downloading it as soon as its manifest is ready, instead of once all manifests of the app are. "
+    "Downloads run in the background with a log per depot, like with --download-jobs",
+    action="store_true",
+)
+
+_options.add_argument(
+    "--keep-going",
+    help="with --download-jobs or --pipeline, keep downloading the other depots after one fails",
+    action="store_true",
+)
+
+_options.add_argument(
+    "--redownload",
+    help="run the downloader even for depots the journal in the download directory records as complete at the same manifest",
+    action="store_true",
+)
+
+_options.add_argument(
     "--downloader",
     metavar="PATH",
     help="DepotDownloaderMod executable",
@@ -97,28 +194,197 @@ _parser.add_argument(
     type=Path,
 )
 
-_parser.add_argument(
+_options.add_argument(
     "--downloader-args",
     metavar="ARGS",
     help="additional arguments to pass to the downloader, as a single string",
 )
 
 
+_parser = argparse.ArgumentParser(
+    "lua2meta", parents=[_options], epilog='run "lua2meta serve --help" for the daemon mode, "lua2meta index --help" to query the --index'
+)
+
+_parser.add_argument(
+    "lua",
+    nargs="*",
+    metavar="PATH",
+    help="path to the .lua file or .zip with lua and .manifest s. Multiple paths, directories and glob patterns are processed as a batch",
+    type=Path,
+)
+
+_parser.add_argument(
+    "--watch",
+    metavar="DIR",
+    help="keep running and process each .lua or .zip input written to the directory. "
+    "Inputs already processed successfully, by content, are skipped across restarts",
+    type=Path,
+)
+
+_parser.add_argument(
+    "--debounce",
+    metavar="SECONDS",
+    help="with --watch, time an input has to stay unchanged before it is processed. Default: 2",
+    default=2,
+    type=float,
+)
+
+_parser.add_argument(
+    "--metrics",
+    metavar="PATH",
+    help="write timings per phase and depot, bytes downloaded, retries, cache hits and peak memory to a file",
+    type=Path,
+)
+
+_parser.add_argument(
+    "--metrics-format",
+    help="format of the --metrics file. Default: json",
+    choices=["json", "prometheus"],
+    default="json",
+)
+
+_serve_parser = argparse.ArgumentParser(
+    "lua2meta serve",
+    parents=[_options],
+    description="keep a Steam session open and process jobs submitted over HTTP. The other options are the defaults of every job",
+)
+
+_serve_parser.add_argument(
+    "--host",
+    metavar="HOST",
+    help="address to listen on. Default: 127.0.0.1",
+    default="127.0.0.1",
+)
+
+_serve_parser.add_argument(
+    "--port",
+    metavar="PORT",
+    help="port to listen on. Default: 8573",
+    default=8573,
+    type=int,
+)
+
+_serve_parser.add_argument(
+    "--socket",
+    metavar="PATH",
+    help="listen on a Unix socket instead of --host and --port",
+    type=Path,
+)
+
+_serve_parser.add_argument(
+    "--token-file",
+    metavar="PATH",
+    help='file holding a token that requests over TCP must send as an "Authorization: Bearer TOKEN" header',
+    type=Path,
+)
+
+_serve_parser.add_argument(
+    "--workers",
+    metavar="N",
+    help="number of jobs processed concurrently. Default: 2",
+    default=2,
+    type=int,
+)
+
+
+_index_parser = argparse.ArgumentParser("lua2meta index", description="query the database written with --index")
+
+_index_parser.add_argument(
+    "index",
+    metavar="PATH",
+    help="the --index database",
+    type=Path,
+)
+
+_index_parser.add_argument(
+    "query",
+    help="apps: the apps with an .acf. depots: the depots of each app, with their manifest, latest known manifest and key. "
+    "outdated: the depots whose manifest is older than the one Steam had when the app was last processed. keys: the depot keys",
+    choices=["apps", "depots", "outdated", "keys"],
+)
+
+_index_parser.add_argument(
+    "appids",
+    nargs="*",
+    metavar="APPID",
+    help="only report these apps",
+    type=int,
+)
+
+_index_parser.add_argument(
+    "--json",
+    help="print a JSON array instead of tab separated columns",
+    action="store_true",
+)
+
+
 @dataclass
-class Args:
-    lua: Path
+class _OptionArgs:
     appid: int
     depots: list[int]
     out_dir: Path
     acf_dir: Path
+    bundle: bool
     offline: bool
     update: bool
+    delta: bool
+    cache_dir: Path
+    cache_ttl: float
+    cache_validate: bool
     api_url: str
+    api_rate: float | None
+    manifest_store: Path
+    index_path: Path
+    skip_indexed: bool
+    jobs: int
     config: Path
     download_dir: Path
     dry_download: bool
+    download_jobs: int
+    pipeline: bool
+    keep_going: bool
+    redownload: bool
     downloader: Path
     downloader_args: str
 
 
-args = cast(Args, _parser.parse_args())
+@dataclass
+class Args(_OptionArgs):
+    lua: list[Path]
+    watch: Path
+    debounce: float
+    metrics: Path
+    metrics_format: str
+
+
+@dataclass
+class ServeArgs(_OptionArgs):
+    host: str
+    port: int
+    socket: Path
+    token_file: Path
+    workers: int
+
+
+@dataclass
+class IndexArgs:
+    index: Path
+    query: str
+    appids: list[int]
+    json: bool
+
+
+def parse_args(argv: Sequence[str] | None = None) -> Args:
+    return cast(Args, _parser.parse_args(argv))
+
+
+def parse_serve_args(argv: Sequence[str] | None = None) -> ServeArgs:
+    return cast(ServeArgs, _serve_parser.parse_args(argv))
+
+
+def parse_index_args(argv: Sequence[str] | None = None) -> IndexArgs:
+    return cast(IndexArgs, _index_parser.parse_args(argv))
+
+
+def to_options(args: _OptionArgs) -> Options:
+    return Options(**{field: getattr(args, field) for field in Options._fields})
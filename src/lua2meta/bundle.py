@@ -0,0 +1,129 @@
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, BinaryIO
+
+__all__ = ["BundleWriter"]
+
+CHUNK_SIZE = 1 << 20
+WINDOW_SIZE = 1 << 15
+LEVEL = 6
+ZIP32_LIMIT = 0xFFFFFFFF
+
+# the earliest date a zip can hold, so that bundles do not depend on when they were written
+DOS_TIME = 0
+DOS_DATE = (0 << 9) | (1 << 5) | 1
+UTF8_FLAG = 0x800
+VERSION = 20
+VERSION_MADE_BY = (3 << 8) | VERSION  # Unix
+EXTERNAL_ATTR = 0o100644 << 16
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+
+
+def compress(data: bytes, window: bytes, last: bool) -> bytes:
+    # a raw deflate stream cut at a byte boundary, so that the chunks of a member can be compressed separately and concatenated.
+    # Priming with the end of the previous chunk keeps the ratio close to compressing the member at once
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, zdict=window) if window else zlib.compressobj(LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class BundleWriter:
+    # a zip whose bytes only depend on its members and the zlib version: members in the order they are added, with fixed
+    # timestamps and permissions. Members are deflated in chunks across threads, zlib releases the GIL while compressing
+    file: BinaryIO
+    workers: int
+    _executor: ThreadPoolExecutor
+    _entries: list[tuple[bytes, int, int, int, int]]  # name, crc, compressed size, size, local header offset
+
+    def __init__(self, file: BinaryIO, workers: int | None = None):
+        self.file = file
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_):
+        try:
+            if exc_type is None:
+                self.close()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+
+    def add(self, name: str, src: IO[bytes]):
+        encoded = name.encode()
+        offset = self.file.tell()
+        self.file.write(LOCAL_HEADER.pack(b"PK\x03\x04", VERSION, UTF8_FLAG, zlib.DEFLATED, DOS_TIME, DOS_DATE, 0, 0, 0, len(encoded), 0))
+        self.file.write(encoded)
+
+        crc = size = compressed_size = 0
+        # bounded, so that memory does not grow with the member
+        pending: deque[Future[bytes]] = deque()
+        window = b""
+        chunk = src.read(CHUNK_SIZE)
+        while True:
+            following = src.read(CHUNK_SIZE) if chunk else b""
+            last = not following
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            pending.append(self._executor.submit(compress, chunk, window, last))
+            window = chunk[-WINDOW_SIZE:]
+            while pending and (len(pending) > 2 * self.workers or last):
+                compressed = pending.popleft().result()
+                self.file.write(compressed)
+                compressed_size += len(compressed)
+            if last:
+                break
+            chunk = following
+
+        if size >= ZIP32_LIMIT or compressed_size >= ZIP32_LIMIT or offset >= ZIP32_LIMIT:
+            raise ValueError(f"{name} is too large for a bundle")
+        # crc and sizes are only known now, the output has to be seekable
+        end = self.file.tell()
+        self.file.seek(offset + 14)
+        self.file.write(struct.pack("<3L", crc, compressed_size, size))
+        self.file.seek(end)
+        self._entries.append((encoded, crc, compressed_size, size, offset))
+
+    def add_bytes(self, name: str, data: bytes):
+        self.add(name, io.BytesIO(data))
+
+    def close(self):
+        if len(self._entries) > 0xFFFF:
+            raise ValueError("Too many members for a bundle")
+        start = self.file.tell()
+        for encoded, crc, compressed_size, size, offset in self._entries:
+            self.file.write(
+                CENTRAL_HEADER.pack(
+                    b"PK\x01\x02",
+                    VERSION_MADE_BY,
+                    VERSION,
+                    UTF8_FLAG,
+                    zlib.DEFLATED,
+                    DOS_TIME,
+                    DOS_DATE,
+                    crc,
+                    compressed_size,
+                    size,
+                    len(encoded),
+                    0,
+                    0,
+                    0,
+                    0,
+                    EXTERNAL_ATTR,
+                    offset,
+                )
+            )
+            self.file.write(encoded)
+        end = self.file.tell()
+        if end >= ZIP32_LIMIT:
+            raise ValueError("Bundle is too large")
+        count = len(self._entries)
+        self.file.write(END_RECORD.pack(b"PK\x05\x06", 0, 0, count, count, end - start, start, 0))
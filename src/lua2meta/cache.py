@@ -0,0 +1,55 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from lua2meta.logger import logger
+from lua2meta.types import AppInfo, AppMetadata, DepotInfo
+from lua2meta.utils import atomic_write_bytes
+
+__all__ = ["MetadataCache"]
+
+
+class MetadataCache:
+    # one json file per app, the file modification time is when the entry was last known to be current
+    path: Path
+    ttl: float
+
+    def __init__(self, path: Path, ttl: float):
+        self.path = path / "appinfo"
+        self.ttl = ttl
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, appid: int) -> Path:
+        return self.path / f"{appid}.json"
+
+    def load(self, appid: int) -> tuple[AppMetadata, bool] | None:
+        entry_path = self._entry_path(appid)
+        try:
+            age = time.time() - entry_path.stat().st_mtime
+            entry = json.loads(entry_path.read_text())
+            metadata = AppMetadata(
+                AppInfo(appid, entry["name"], Path(entry["install_dir"]), entry["build_id"]),
+                {int(depot): DepotInfo(*depot_info) for depot, depot_info in entry["depots"].items()},
+                entry["change_number"],
+            )
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            logger.warning(f"Ignoring unreadable cache entry {entry_path}: {ex!r}")
+            return None
+        return (metadata, age < self.ttl)
+
+    def store(self, metadata: AppMetadata):
+        app_info = metadata.app_info
+        entry = {
+            "name": app_info.name,
+            "install_dir": str(app_info.install_dir),
+            "build_id": app_info.build_id,
+            "depots": {str(depot): list(depot_info) for depot, depot_info in metadata.depot_infos.items()},
+            "change_number": metadata.change_number,
+        }
+        atomic_write_bytes(self._entry_path(app_info.appid), json.dumps(entry).encode())
+
+    def touch(self, appid: int):
+        os.utime(self._entry_path(appid))
@@ -0,0 +1,32 @@
+from lua2meta.logger import logger
+
+__all__ = ["changed_files"]
+
+# EDepotFileFlag.Directory, steam.enums is only imported along with the manifest parser
+DIRECTORY_FLAG = 64
+
+
+def manifest_files(data: bytes, depot_key: bytes) -> dict[str, tuple[bytes, int, str]]:
+    from steam.core.manifest import DepotManifest
+
+    manifest = DepotManifest(data)
+    manifest.decrypt_filenames(depot_key)
+    files: dict[str, tuple[bytes, int, str]] = {}
+    for mapping in manifest.payload.mappings:  # pyright: ignore[reportAttributeAccessIssue]
+        if mapping.flags & DIRECTORY_FLAG:
+            continue
+        # the downloader matches file lists against forward slash separated paths
+        name = mapping.filename.rstrip("\x00 \n\t").replace("\\", "/")
+        files[name] = (mapping.sha_content, mapping.flags, mapping.linktarget)
+    return files
+
+
+def changed_files(old: bytes, new: bytes, depot_key: str) -> list[str]:
+    # files of the new manifest that are missing from the old one or differ in content, flags or link target
+    key = bytes.fromhex(depot_key)
+    old_files = manifest_files(old, key)
+    new_files = manifest_files(new, key)
+    changed = [name for name, entry in new_files.items() if old_files.get(name) != entry]
+    if removed := old_files.keys() - new_files.keys():
+        logger.info(f"{len(removed)} files are no longer part of the depot, they are left in place")
+    return changed
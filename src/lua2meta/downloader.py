@@ -0,0 +1,187 @@
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from pathlib import Path
+from typing import IO
+
+from lua2meta.logger import logger
+from lua2meta.metrics import Metrics
+
+__all__ = ["DownloaderPool", "run_parallel"]
+
+STATUS_INTERVAL = 10
+POLL_INTERVAL = 0.5
+_PROGRESS = re.compile(rb"(\d{1,3}(?:\.\d+)?)%")
+
+
+class DownloaderJob:
+    depot: int
+    log_path: Path
+    process: subprocess.Popen[bytes]
+    progress: str
+    started: float
+    _reader: threading.Thread
+
+    def __init__(self, depot: int, argv: list[str], log_path: Path):
+        self.depot = depot
+        self.log_path = log_path
+        self.progress = "starting"
+        self.started = time.monotonic()
+        log_file = log_path.open("wb")
+        self.process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._reader = threading.Thread(target=self._read, args=(log_file,), daemon=True)
+        self._reader.start()
+
+    def _read(self, log_file: IO[bytes]):
+        # the downloader reports progress as "12.34% path", remember the last one seen
+        assert self.process.stdout
+        with log_file:
+            for line in self.process.stdout:
+                log_file.write(line)
+                if match := _PROGRESS.search(line):
+                    self.progress = f"{match.group(1).decode()}%"
+
+    def poll(self) -> int | None:
+        returncode = self.process.poll()
+        if returncode is not None:
+            self._reader.join()
+        return returncode
+
+    def terminate(self) -> int:
+        self.process.terminate()
+        returncode = self.process.wait()
+        self._reader.join()
+        return returncode
+
+
+class DownloaderPool:
+    # runs up to `jobs` downloaders at once, from a background thread, for depots submitted at any time until wait()
+    jobs: int
+    keep_going: bool
+    metrics: Metrics
+    completed: Callable[[int], None]
+    returncodes: dict[int, int]
+    _pending: deque[tuple[int, list[str], Path]]
+    _submitted: int
+    _closed: bool
+    _aborted: bool
+    _error: BaseException | None
+    _lock: threading.Lock
+    _wake: threading.Event
+    _thread: threading.Thread
+
+    def __init__(self, jobs: int, keep_going: bool, metrics: Metrics, completed: Callable[[int], None]):
+        self.jobs = jobs
+        self.keep_going = keep_going
+        self.metrics = metrics
+        self.completed = completed
+        self.returncodes = {}
+        self._pending = deque()
+        self._submitted = 0
+        self._closed = False
+        self._aborted = False
+        self._error = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_):
+        if exc_type is not None:
+            self.abort()
+        self.wait()
+
+    def submit(self, depot: int, argv: list[str], log_path: Path):
+        with self._lock:
+            assert not self._closed
+            self._pending.append((depot, argv, log_path))
+            self._submitted += 1
+        self._wake.set()
+
+    def wait(self) -> dict[int, int]:
+        # no more submissions. Returns the exit status of each depot that ran, the others were skipped after a failure
+        with self._lock:
+            self._closed = True
+        self._wake.set()
+        self._thread.join()
+        if self._error:
+            raise self._error
+        return self.returncodes
+
+    def abort(self):
+        with self._lock:
+            self._aborted = True
+            self._closed = True
+        self._wake.set()
+
+    def _run(self):
+        running: dict[int, DownloaderJob] = {}
+        last_status = time.monotonic()
+        failed = False
+        try:
+            while True:
+                with self._lock:
+                    if self._aborted or (failed and not self.keep_going):
+                        self._pending.clear()
+                    if self._aborted:
+                        break
+                    if self._closed and not self._pending and not running:
+                        return
+                    while self._pending and len(running) < self.jobs:
+                        depot, argv, log_path = self._pending.popleft()
+                        running[depot] = DownloaderJob(depot, argv, log_path)
+                        logger.info(f"Downloading depot {depot}, log at {log_path}")
+
+                for depot, job in list(running.items()):
+                    if (returncode := job.poll()) is None:
+                        continue
+                    del running[depot]
+                    self.returncodes[depot] = returncode
+                    self.metrics.record("downloader", time.monotonic() - job.started, depot)
+                    if returncode:
+                        failed = True
+                        logger.error(f"Downloader for depot {depot} terminated with a non-zero status {returncode}, see {job.log_path}")
+                    else:
+                        logger.info(f"Depot {depot} downloaded")
+                        self.completed(depot)
+
+                if failed and not self.keep_going:
+                    for depot, job in running.items():
+                        logger.warning(f"Stopping downloader for depot {depot}")
+                        self.returncodes[depot] = job.terminate()
+                        self.metrics.record("downloader", time.monotonic() - job.started, depot)
+                    running.clear()
+
+                if running and time.monotonic() - last_status >= STATUS_INTERVAL:
+                    last_status = time.monotonic()
+                    status = ", ".join(f"{depot}: {job.progress}" for depot, job in running.items())
+                    logger.info(f"[{len(self.returncodes)}/{self._submitted} done] {status}")
+                # until a downloader may have exited, or depots are submitted
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+        except BaseException as ex:
+            # raised again by wait(), on the thread that submitted the depots
+            self._error = ex
+        finally:
+            for job in running.values():
+                job.terminate()
+
+
+def run_parallel(
+    commands: dict[int, list[str]],
+    log_paths: dict[int, Path],
+    jobs: int,
+    keep_going: bool,
+    metrics: Metrics,
+    completed: Callable[[int], None],
+) -> dict[int, int]:
+    with DownloaderPool(jobs, keep_going, metrics, completed) as pool:
+        for depot, argv in commands.items():
+            pool.submit(depot, argv, log_paths[depot])
+        return pool.wait()
@@ -0,0 +1,160 @@
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any
+
+from lua2meta.types import AppInfo, DepotInfos, DepotKeys
+
+__all__ = ["ArchiveIndex"]
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    appid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    install_dir TEXT NOT NULL,
+    build_id INTEGER NOT NULL,
+    acf_path TEXT NOT NULL,
+    written REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS depots (
+    appid INTEGER NOT NULL,
+    depot INTEGER NOT NULL,
+    key TEXT,
+    gid INTEGER,
+    size INTEGER,
+    latest_gid INTEGER,
+    written REAL,
+    checked REAL,
+    PRIMARY KEY (appid, depot)
+);
+CREATE TABLE IF NOT EXISTS manifests (
+    depot INTEGER NOT NULL,
+    gid INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    written REAL NOT NULL,
+    PRIMARY KEY (depot, gid)
+);
+"""
+
+
+class ArchiveIndex:
+    # what the output directories hold, kept next to them so that it is not necessary to list them.
+    # depots.gid is the manifest written to the .acf, depots.latest_gid the one Steam had when the app was last processed
+    path: Path
+    _db: sqlite3.Connection
+
+    def __init__(self, path: Path):
+        self.path = path
+        # concurrent runs and serve workers wait for each other's transactions
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            self._db.close()
+            raise ValueError(f"Index {path} was created by a newer version of lua2meta")
+        with self._db:
+            self._db.executescript(SCHEMA)
+            self._db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def put_keys(self, appid: int, depot_keys: DepotKeys):
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO depots (appid, depot, key, written) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (appid, depot) DO UPDATE SET key = excluded.key, written = excluded.written",
+                [(appid, depot, key, now) for depot, key in depot_keys.items()],
+            )
+
+    def put_manifests(self, paths: dict[tuple[int, int], Path]):
+        # (depot, gid) -> the .manifest file, or the bundle holding it
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO manifests (depot, gid, path, written) VALUES (?, ?, ?, ?)",
+                [(depot, gid, str(path.absolute()), now) for (depot, gid), path in paths.items()],
+            )
+
+    def put_app(self, acf_path: Path, app_info: AppInfo, depot_infos: DepotInfos):
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO apps (appid, name, install_dir, build_id, acf_path, written) VALUES (?, ?, ?, ?, ?, ?)",
+                (app_info.appid, app_info.name, str(app_info.install_dir), app_info.build_id, str(acf_path.absolute()), now),
+            )
+            self._db.executemany(
+                "INSERT INTO depots (appid, depot, gid, size, written) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (appid, depot) DO UPDATE SET gid = excluded.gid, size = excluded.size, written = excluded.written",
+                [(app_info.appid, depot, depot_info.gid, depot_info.size, now) for depot, depot_info in depot_infos.items()],
+            )
+
+    def put_latest(self, appid: int, depot_infos: DepotInfos):
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO depots (appid, depot, latest_gid, checked) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (appid, depot) DO UPDATE SET latest_gid = excluded.latest_gid, checked = excluded.checked",
+                [(appid, depot, depot_info.gid, now) for depot, depot_info in depot_infos.items()],
+            )
+
+    def is_current(self, appid: int, build_id: int, depot_keys: DepotKeys, depot_infos: DepotInfos) -> bool:
+        # the .acf was written for this build, and every depot has the same key and an indexed manifest at Steam's gid
+        row = self._db.execute("SELECT build_id FROM apps WHERE appid = ?", (appid,)).fetchone()
+        if row is None or row[0] != build_id:
+            return False
+        indexed = {
+            depot: (key, gid)
+            for depot, key, gid in self._db.execute(
+                "SELECT depots.depot, key, depots.gid FROM depots JOIN manifests USING (depot, gid) WHERE appid = ?", (appid,)
+            )
+        }
+        return all(indexed.get(depot) == (key, depot_infos[depot].gid) for depot, key in depot_keys.items())
+
+    def _query(self, sql: str, params: tuple[Any, ...] = ()) -> list[dict[str, Any]]:
+        cursor = self._db.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    @staticmethod
+    def _appid_filter(appids: list[int] | None) -> tuple[str, tuple[int, ...]]:
+        if not appids:
+            return "", ()
+        return f"WHERE appid IN ({', '.join('?' * len(appids))})", tuple(appids)
+
+    def apps(self, appids: list[int] | None = None) -> list[dict[str, Any]]:
+        where, params = self._appid_filter(appids)
+        return self._query(
+            "SELECT appid, name, build_id, (SELECT count(*) FROM depots WHERE depots.appid = apps.appid) AS depots, written "
+            f"FROM apps {where} ORDER BY appid",
+            params,
+        )
+
+    def depots(self, appids: list[int] | None = None) -> list[dict[str, Any]]:
+        where, params = self._appid_filter(appids)
+        return self._query(
+            f"SELECT appid, depot, gid, size, latest_gid, key, written, checked FROM depots {where} ORDER BY appid, depot", params
+        )
+
+    def outdated(self, appids: list[int] | None = None) -> list[dict[str, Any]]:
+        # depots whose archived manifest is not the one Steam had when last checked, or that were never archived
+        where, params = self._appid_filter(appids)
+        where = f"{where} AND" if where else "WHERE"
+        return self._query(
+            f"SELECT appid, depot, gid, latest_gid, checked FROM depots {where} latest_gid IS NOT NULL AND gid IS NOT latest_gid "
+            "ORDER BY appid, depot",
+            params,
+        )
+
+    def keys(self, appids: list[int] | None = None) -> list[dict[str, Any]]:
+        where, params = self._appid_filter(appids)
+        where = f"{where} AND" if where else "WHERE"
+        return self._query(f"SELECT DISTINCT depot, key FROM depots {where} key IS NOT NULL ORDER BY depot", params)
@@ -0,0 +1,47 @@
+import os
+import threading
+from pathlib import Path
+
+from lua2meta.logger import logger
+
+__all__ = ["DownloadJournal"]
+
+JOURNAL_NAME = ".lua2meta-downloads"
+
+
+class DownloadJournal:
+    # one "appid depot gid" line per depot the downloader completed. Lines are only ever appended, so that an
+    # interrupted run loses at most the depot it was working on
+    path: Path
+    completed: set[tuple[int, int, int]]
+    _lock: threading.Lock
+
+    def __init__(self, download_dir: Path):
+        self.path = download_dir / JOURNAL_NAME
+        self.completed = set()
+        self._lock = threading.Lock()
+        try:
+            lines = self.path.read_text().splitlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                appid, depot, gid = map(int, line.split())
+            except ValueError:
+                # a line cut short by a crash
+                logger.warning(f"Ignoring malformed line in download journal {self.path}: {line!r}")
+                continue
+            self.completed.add((appid, depot, gid))
+
+    def is_complete(self, appid: int, depot: int, gid: int) -> bool:
+        return (appid, depot, gid) in self.completed
+
+    def complete(self, appid: int, depot: int, gid: int):
+        with self._lock:
+            if (appid, depot, gid) in self.completed:
+                return
+            with self.path.open("a") as file:
+                file.write(f"{appid} {depot} {gid}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.completed.add((appid, depot, gid))
@@ -1,13 +1,23 @@
 import logging
 import sys
 
-__all__ = ["logger"]
+__all__ = ["logger", "print_line"]
 
 logger = logging.getLogger("lua2meta")
 logger.setLevel(logging.INFO)
 
-formatter = logging.Formatter('%(levelname)s: %(message)s')
+formatter = logging.Formatter("%(levelname)s: %(message)s")
 console_handler = logging.StreamHandler(sys.stdout)
 
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
+
+
+def print_line(line: str):
+    # in one write under the console handler's lock, so that it does not interleave with log records from other threads
+    console_handler.acquire()
+    try:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+    finally:
+        console_handler.release()
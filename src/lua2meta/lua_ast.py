@@ -0,0 +1,58 @@
+from typing import TYPE_CHECKING, override
+
+import luaparser.ast as last
+from luaparser import astnodes
+
+if TYPE_CHECKING:
+    from lua2meta.lua_parser import LuaCalls
+
+__all__ = ["visit"]
+
+
+class CallVisitor(last.ASTVisitor):
+    calls: "LuaCalls"
+
+    @override
+    def __init__(self, calls: "LuaCalls"):
+        super().__init__()
+        self.calls = calls
+
+    def visit_Call(self, node: astnodes.Call):
+        if not isinstance(node.func, astnodes.Name):
+            return
+        if node.func.id == "setManifestid":
+            self.visit_set_manifest(node)
+        if node.func.id != "addappid":
+            return
+        match len(node.args):
+            case 1:
+                if not isinstance(node.args[0], astnodes.Number):
+                    return
+                self.calls.add_appid(node.args[0].n)
+            case 3:
+                if not isinstance(node.args[0], astnodes.Number):
+                    return
+                if not isinstance(node.args[2], astnodes.String):
+                    return
+                self.calls.add_depot(node.args[0].n, node.args[2].s.decode("utf-8"))
+
+    def visit_set_manifest(self, node: astnodes.Call):
+        if len(node.args) not in (2, 3) or not isinstance(node.args[0], astnodes.Number):
+            return
+        depot = node.args[0].n
+        if not isinstance(depot, int):
+            return
+        gid = node.args[1]
+        if isinstance(gid, astnodes.String) and gid.s.isdigit():
+            gid = int(gid.s)
+        elif isinstance(gid, astnodes.Number) and isinstance(gid.n, int):
+            gid = gid.n
+        else:
+            return
+        size = node.args[2].n if len(node.args) == 3 and isinstance(node.args[2], astnodes.Number) else 0
+        self.calls.set_manifest(depot, gid, int(size))
+
+
+def visit(src: str, calls: "LuaCalls"):
+    tree = last.parse(src)  # raises ast.SyntaxException
+    CallVisitor(calls).visit(tree)
@@ -1,67 +1,161 @@
-from typing import override
+import re
 
-import luaparser.ast as last
-from luaparser import astnodes
-
-from lua2meta.args import args
 from lua2meta.logger import logger
-from lua2meta.types import DepotKeys
+from lua2meta.types import DepotInfo, DepotInfos, DepotKeys
 
 __all__ = ["parse"]
 
+# Lua tokens, only literals need to be told apart precisely, anything else is a name or an operator
+_TOKEN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>--(?:\[(?P<comment_level>=*)\[.*?\](?P=comment_level)\]|[^\n]*))
+    | (?P<long_string>\[(?P<string_level>=*)\[.*?\](?P=string_level)\])
+    | (?P<string>"[^"\\\n]*"|'[^'\\\n]*')
+    | (?P<escaped_string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    | (?P<number>0[xX][0-9a-fA-F.]+(?:[pP][+-]?\d+)?|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>\.\.\.|\.\.|==|~=|<=|>=|<<|>>|//|::|\S)
+    """,
+    re.VERBOSE | re.DOTALL | re.ASCII,
+)
+_OPAQUE = object()
+_CALLS = ("addappid", "setManifestid")
+_DIGITS = re.compile(r"[0-9]+")
+_KEYWORDS = {
+    "and",
+    "break",
+    "do",
+    "else",
+    "elseif",
+    "end",
+    "false",
+    "for",
+    "function",
+    "goto",
+    "if",
+    "in",
+    "local",
+    "nil",
+    "not",
+    "or",
+    "repeat",
+    "return",
+    "then",
+    "true",
+    "until",
+    "while",
+}
+
 
-class CallVisitor(last.ASTVisitor):
+class LuaCalls:
     appid: int | None
     depots: DepotKeys
     first_depot: int | None
+    manifests: DepotInfos  # from setManifestid(), dlc_app_id is always None
 
-    @override
     def __init__(self):
-        super().__init__()
         self.appid = None
         self.depots = {}
         self.first_depot = None
+        self.manifests = {}
 
-    def visit_Call(self, node: astnodes.Call):
-        if not (isinstance(node.func, astnodes.Name) and node.func.id == "addappid"):
+    def add_appid(self, appid: int):
+        if self.appid is not None:
+            logger.warning(f"Duplicate appid found in lua file, skipping {appid}")
             return
-        match len(node.args):
-            case 1:
-                if not isinstance(node.args[0], astnodes.Number):
-                    return
-                appid: int = node.args[0].n
-                if self.appid is not None:
-                    logger.warning(f"Duplicate appid found in lua file, skipping {appid}")
-                    return
-                self.appid = appid
-            case 3:
-                if not isinstance(node.args[0], astnodes.Number):
-                    return
-                if not isinstance(node.args[2], astnodes.String):
-                    return
-                appid: int = node.args[0].n
-                key: str = node.args[2].s.decode("utf-8")
-                if self.first_depot is None:
-                    self.first_depot = appid
-                self.depots[appid] = key
-                logger.info(f"Parsed depot {appid}:{key}")
-
-
-def parse(src: str) -> tuple[int, DepotKeys]:
-    tree = last.parse(src)  # raises ast.SyntaxException
-    call_visitor = CallVisitor()
-    call_visitor.visit(tree)
-    if call_visitor.appid is None and call_visitor.first_depot is not None:
-        depot = call_visitor.first_depot
-        call_visitor.appid = depot
-        call_visitor.depots.pop(depot)
+        self.appid = appid
+
+    def add_depot(self, depot: int, key: str):
+        if self.first_depot is None:
+            self.first_depot = depot
+        self.depots[depot] = key
+        logger.info(f"Parsed depot {depot}:{key}")
+
+    def set_manifest(self, depot: int, gid: int, size: int):
+        if depot in self.manifests and self.manifests[depot].gid != gid:
+            logger.warning(f"Duplicate setManifestid() for depot {depot}, using {gid}")
+        self.manifests[depot] = DepotInfo(gid, size, None)
+
+
+class UnsupportedSyntax(Exception):
+    pass
+
+
+def _literal(kind: str | None, text: str) -> int | str | object:
+    match kind:
+        case "number" if _DIGITS.fullmatch(text):
+            return int(text)
+        case "string":
+            return text[1:-1]
+        case "name" if text not in _KEYWORDS or text in ("true", "false", "nil"):
+            return _OPAQUE
+    raise UnsupportedSyntax(text)
+
+
+def scan_calls(src: str) -> list[tuple[str, list[int | str | object]]]:
+    # the name and arguments of every addappid() and setManifestid() call, as long as the file is nothing but calls to plain names
+    # with plain literal or name arguments. Anything else goes to the full parser, which also rejects the broken files
+    tokens = [(match.lastgroup, match.group()) for match in _TOKEN.finditer(src) if match.lastgroup not in ("space", "comment")]
+    calls: list[tuple[str, list[int | str | object]]] = []
+    i = 0
+    try:
+        while i < len(tokens):
+            kind, text = tokens[i]
+            if text == ";":
+                i += 1
+                continue
+            if kind != "name" or text in _KEYWORDS or tokens[i + 1][1] != "(":
+                raise UnsupportedSyntax(text)
+            call_args: list[int | str | object] = []
+            i += 2
+            if tokens[i][1] != ")":
+                while True:
+                    call_args.append(_literal(*tokens[i]))
+                    if tokens[i + 1][1] == ")":
+                        i += 1
+                        break
+                    if tokens[i + 1][1] != ",":
+                        raise UnsupportedSyntax(tokens[i + 1][1])
+                    i += 2
+            i += 1
+            if text in _CALLS:
+                calls.append((text, call_args))
+    except IndexError:
+        raise UnsupportedSyntax("unexpected end of file") from None
+    return calls
+
+
+def parse(src: str, appid: int | None = None) -> tuple[int, DepotKeys, DepotInfos]:
+    calls = LuaCalls()
+    try:
+        scanned_calls = scan_calls(src)
+    except UnsupportedSyntax as ex:
+        logger.info(f'Unusual syntax "{ex}", parsing the full .lua syntax tree')
+        from lua2meta import lua_ast
+
+        lua_ast.visit(src, calls)
+    else:
+        for name, call_args in scanned_calls:
+            match name, call_args:
+                case "addappid", [int() as id]:
+                    calls.add_appid(id)
+                case "addappid", [int() as depot, _, str() as key]:
+                    calls.add_depot(depot, key)
+                case "setManifestid", [int() as depot, str() | int() as gid, *size] if _DIGITS.fullmatch(str(gid)) and len(size) <= 1:
+                    calls.set_manifest(depot, int(gid), size[0] if size and isinstance(size[0], int) else 0)
+
+    if calls.appid is None and calls.first_depot is not None:
+        depot = calls.first_depot
+        calls.appid = depot
+        calls.depots.pop(depot)
         logger.warning(f"Guessed appid {depot} from first addappid()")
 
-    if args.appid is not None:
-        if call_visitor.appid is not None and call_visitor.appid != args.appid:
-            logger.warning(f"Appid {call_visitor.appid} in .lua file does not match provided {args.appid}")
-        call_visitor.appid = args.appid
-    elif call_visitor.appid is None:
-        raise last.SyntaxException(".lua file does not specify an appid")
+    if appid is not None:
+        if calls.appid is not None and calls.appid != appid:
+            logger.warning(f"Appid {calls.appid} in .lua file does not match provided {appid}")
+        calls.appid = appid
+    elif calls.appid is None:
+        raise ValueError(".lua file does not specify an appid")
 
-    return (call_visitor.appid, call_visitor.depots)
+    return (calls.appid, calls.depots, calls.manifests)
@@ -0,0 +1,139 @@
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+__all__ = ["Metrics", "peak_memory"]
+
+
+def peak_memory() -> int | None:
+    # peak resident set size of the process in bytes
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+class Metrics:
+    # collected over one run and shared by its threads. Times are wall seconds, summed when a phase runs more than once
+    started: float
+    phases: dict[str, float]
+    depots: dict[int, dict[str, float]]  # depot -> phase -> seconds, plus "bytes"
+    hosts: dict[str, dict[str, float]]  # content server -> requests, errors, bytes, seconds
+    counters: Counter[str]
+    _lock: threading.Lock
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = defaultdict(float)
+        self.depots = defaultdict(lambda: defaultdict(int))
+        self.hosts = defaultdict(lambda: defaultdict(int))
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, depot: int | None = None) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, depot)
+
+    def record(self, name: str, seconds: float, depot: int | None = None):
+        with self._lock:
+            if depot is None:
+                self.phases[name] += seconds
+            else:
+                self.depots[depot][name] += seconds
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def downloaded(self, host: str, depot: int, size: int, seconds: float):
+        with self._lock:
+            self.counters["bytes_downloaded"] += size
+            self.depots[depot]["bytes"] += size
+            self.hosts[host]["requests"] += 1
+            self.hosts[host]["bytes"] += size
+            self.hosts[host]["seconds"] += seconds
+
+    def host_failed(self, host: str):
+        with self._lock:
+            self.hosts[host]["requests"] += 1
+            self.hosts[host]["errors"] += 1
+
+    def report(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "started": self.started,
+                "wall_seconds": time.time() - self.started,
+                "peak_memory_bytes": peak_memory(),
+                "phases": dict(self.phases),
+                "depots": {str(depot): dict(phases) for depot, phases in sorted(self.depots.items())},
+                "hosts": {host: dict(counter) for host, counter in sorted(self.hosts.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self) -> str:
+        report = self.report()
+        lines: list[str] = []
+
+        def family(name: str, type: str, samples: list[tuple[dict[str, str], float | int | None]]):
+            lines.append(f"# TYPE lua2meta_{name} {type}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label = ",".join(f'{key}="{label_value}"' for key, label_value in labels.items())
+                lines.append(f"lua2meta_{name}{{{label}}} {value}" if label else f"lua2meta_{name} {value}")
+
+        family("wall_seconds", "gauge", [({}, report["wall_seconds"])])
+        family("peak_memory_bytes", "gauge", [({}, report["peak_memory_bytes"])])
+        family("phase_seconds", "gauge", [({"phase": phase}, seconds) for phase, seconds in report["phases"].items()])
+        family(
+            "depot_seconds",
+            "gauge",
+            [
+                ({"depot": depot, "phase": phase}, value)
+                for depot, phases in report["depots"].items()
+                for phase, value in phases.items()
+                if phase != "bytes"
+            ],
+        )
+        family("depot_bytes", "gauge", [({"depot": depot}, phases.get("bytes", 0)) for depot, phases in report["depots"].items()])
+        for key in ("requests", "errors", "bytes", "seconds"):
+            family(f"host_{key}_total", "counter", [({"host": host}, counter.get(key, 0)) for host, counter in report["hosts"].items()])
+        for name, value in report["counters"].items():
+            family(f"{name}_total", "counter", [({}, value)])
+        return "\n".join(lines) + "\n"
@@ -1,24 +1,51 @@
+import email.utils
 import errno
-import io
+import itertools
 import os
-from pathlib import Path
+import shutil
+import threading
+import time
 import zipfile
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Protocol, Self
 
-import requests
-import requests.adapters
-from requests.adapters import HTTPAdapter
-from steam.client import SteamClient
-from steam.client.cdn import CDNClient, ContentServer
-from urlpath import URL
-
-from lua2meta.args import args
 from lua2meta.logger import logger
-from lua2meta.types import AppInfo, DepotInfo, DepotInfos, Manifest
+from lua2meta.metrics import Metrics
+from lua2meta.types import AppInfo, AppMetadata, DepotInfo, DepotInfos, Manifest
+from lua2meta.utils import atomic_open, temp_path
+
+# steam (gevent) and requests take a while to import, they are only loaded once the network is actually used
+if TYPE_CHECKING:
+    import requests
+    from steam.client import SteamClient
+    from urlpath import URL
 
-__all__ = ["fetch_manifest"]
+__all__ = ["CDNPool", "SteamSession", "fetch_change_numbers", "fetch_manifest", "fetch_metadata"]
 
+# apps per PICS product info request
+PRODUCT_INFO_CHUNK_SIZE = 100
+# request codes rotate every few minutes, keep them for less than that
+REQUEST_CODE_TTL = 240
+REQUEST_CODE_ATTEMPTS = 8
+MIN_REQUEST_RATE = 0.05
+# share of the rate that was rate limited, regained on each success
+RATE_RECOVERY = 0.05
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+CDN_TIMEOUT = 30
+CDN_PROBE_TIMEOUT = 5
+CDN_PROBE_SERVERS = 8
+CDN_ATTEMPTS = 4
+
+
+def initialize_mrc_session() -> "requests.Session":
+    import requests
+    import requests.adapters
+    from requests.adapters import HTTPAdapter
 
-def initialize_mrc_session():
     # A respectful strategy for a mysterious endpoint
     retry_strategy = requests.adapters.Retry(
         total=5,  # total retry attempts
@@ -26,7 +53,7 @@ def initialize_mrc_session():
         # read=5,  # retry on read errors
         # status=5,  # retry on bad status codes
         backoff_factor=2,  # exponential backoff
-        status_forcelist=[429, 500, 502, 503, 504],  # transient failures
+        status_forcelist=[500, 502, 503, 504],  # transient failures, 429 is left to mrc_limiter
         allowed_methods=["GET"],
         # respect_retry_after_header=False,
     )
@@ -38,14 +65,304 @@ def initialize_mrc_session():
     return session
 
 
-mrc_session = initialize_mrc_session()
+class RateLimiter:
+    # token bucket shared by every caller, only once the endpoint answered 429 unless max_rate is given. The rate is
+    # halved on each 429 and recovers additively on success, up to max_rate if any
+    max_rate: float | None
+    rate: float | None
+    increase: float
+    tokens: float
+    updated: float
+    blocked_until: float
+    recent: deque[float]  # requests of the last second while unlimited, to know the rate that got limited
+    _lock: threading.Lock
+
+    def __init__(self, max_rate: float | None = None):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.increase = 0
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.recent = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    self.recent.append(now)
+                    while self.recent[0] <= now - 1:
+                        self.recent.popleft()
+                    return
+                self.tokens = min(1, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def throttled(self, retry_after: float | None):
+        with self._lock:
+            if self.rate is not None and time.monotonic() < self.blocked_until:
+                # sent before the previous 429 was answered, the rate was already lowered for it
+                if retry_after is not None:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                return
+            limited = float(len(self.recent)) if self.rate is None else self.rate
+            self.rate = max(limited / 2, MIN_REQUEST_RATE)
+            self.increase = max(limited * RATE_RECOVERY, MIN_REQUEST_RATE)
+            self.recent.clear()
+            self.tokens = 0
+            delay = 1 / self.rate if retry_after is None else retry_after
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            logger.warning(f"Rate limited by request code endpoint, waiting {delay:.1f}s and slowing down to {self.rate:.2f} requests/s")
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate is None:
+                return
+            self.rate += self.increase
+            if self.max_rate is not None:
+                self.rate = min(self.max_rate, self.rate)
+
+
+def retry_after(response: "requests.Response") -> float | None:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (email.utils.parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class ContentServerAddress(Protocol):
+    # the parts of a steam ContentServer that are used here
+    @property
+    def host(self) -> str: ...
+    @property
+    def port(self) -> int: ...
+    @property
+    def https(self) -> bool: ...
+
+
+class ContentServerConnection:
+    host: str
+    url: "URL"
+    session: "requests.Session"
+    latency: float
+    errors: float
+
+    def __init__(self, server: ContentServerAddress):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urlpath import URL
+
+        self.host = str(server.host)
+        self.url = URL("").with_components(
+            hostname=server.host,
+            port=server.port,
+            scheme="https" if server.https else "http",
+        )
+        # keep-alive connections to this server, shared by every fetch thread
+        self.session = requests.Session()
+        self.session.mount(str(self.url), HTTPAdapter(pool_maxsize=16))
+        self.latency = CDN_TIMEOUT
+        self.errors = 0
+
+    @property
+    def score(self) -> float:
+        return self.latency * (1 + self.errors)
+
+    def succeeded(self, latency: float):
+        self.latency = latency if self.latency == CDN_TIMEOUT else 0.7 * self.latency + 0.3 * latency
+        self.errors *= 0.5
+
+    def failed(self):
+        # counts as a sample as slow as the timeout
+        self.latency = 0.7 * self.latency + 0.3 * CDN_TIMEOUT
+        self.errors += 1
+
+    def probe(self):
+        import requests
+
+        start = time.monotonic()
+        try:
+            # any answer at all tells how far away the server is
+            self.session.head(str(self.url), timeout=CDN_PROBE_TIMEOUT).close()
+        except requests.RequestException:
+            self.failed()
+            return
+        self.succeeded(time.monotonic() - start)
+
+
+class CDNPool:
+    # content servers ranked by measured latency and error rate, failing over to the next one on errors
+    connections: list[ContentServerConnection]
+
+    def __init__(self, servers: Iterable[ContentServerAddress]):
+        self.connections = [ContentServerConnection(server) for server in servers]
+        if not self.connections:
+            raise OSError(errno.ENOENT, "No content servers available")
+        with ThreadPoolExecutor(max_workers=CDN_PROBE_SERVERS) as executor:
+            for connection in self.connections[:CDN_PROBE_SERVERS]:
+                executor.submit(connection.probe)
+        ranked = self.ranked()
+        logger.info(f"Using content server {ranked[0].host} ({ranked[0].latency * 1000:.0f}ms) out of {len(ranked)}")
+
+    def ranked(self) -> list[ContentServerConnection]:
+        return sorted(self.connections, key=lambda connection: connection.score)
+
+    def download(self, path: str, dst: Path, metrics: Metrics, depot: int):
+        import requests
 
+        error: Exception | None = None
+        for connection in self.ranked()[:CDN_ATTEMPTS]:
+            url = f"{connection.url}/{path}"
+            logger.info(f"Download manifest from {url}")
+            start = time.monotonic()
+            size = 0
+            try:
+                with connection.session.get(url, stream=True, timeout=CDN_TIMEOUT) as response:
+                    # rate limited, overloaded or missing the manifest, another server may still have it
+                    if response.status_code != 200:
+                        raise requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+                    latency = time.monotonic() - start
+                    with dst.open("wb") as file:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            file.write(chunk)
+                            size += len(chunk)
+            except requests.RequestException as ex:
+                connection.failed()
+                metrics.host_failed(connection.host)
+                metrics.count("cdn_failovers")
+                logger.warning(f"Content server {connection.host} failed, trying the next one: {ex}")
+                error = ex
+                continue
+            connection.succeeded(latency)
+            metrics.downloaded(connection.host, depot, size, time.monotonic() - start)
+            return
+        assert error
+        raise error
 
-def fetch_metadata(client: SteamClient, appid: int) -> tuple[AppInfo, DepotInfos]:
-    product_info = client.get_product_info((appid,), auto_access_tokens=False)
-    if product_info is None:
-        raise KeyError("apps", "No response from steam api")
-    app = product_info["apps"][appid]
+
+class SteamSession:
+    # logs in on first use, so that a run never pays for more than one login. Can be shared by any number of apps
+    api_rate: float | None
+    request_codes: dict[tuple[int, int, int], tuple[float, str]]  # (appid, depot, gid) -> (expiry, request code)
+    _client: "SteamClient | None"
+    _client_executor: ThreadPoolExecutor | None
+    _cdn_pool: CDNPool | None
+    _mrc_session: "requests.Session | None"
+    _mrc_limiter: RateLimiter | None
+    _lock: threading.RLock
+
+    def __init__(self, api_rate: float | None = None):
+        self.api_rate = api_rate
+        self.request_codes = {}
+        self._client = None
+        self._client_executor = None
+        self._cdn_pool = None
+        self._mrc_session = None
+        self._mrc_limiter = None
+        self._lock = threading.RLock()
+
+    def _login(self) -> "SteamClient":
+        # a long lived session may have been disconnected since the last call
+        if self._client is None or not self._client.logged_on:
+            from steam.client import SteamClient
+
+            client = SteamClient()
+            client.anonymous_login()
+            logger.info("Logged in anonymously")
+            self._client = client
+        return self._client
+
+    def run_client[T](self, fn: Callable[["SteamClient"], T]) -> T:
+        # SteamClient runs on gevent, whose hub belongs to a single thread. All calls go through the same thread,
+        # which also serializes requests of concurrent jobs on the shared connection
+        with self._lock:
+            if self._client_executor is None:
+                self._client_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="steam")
+            executor = self._client_executor
+        return executor.submit(lambda: fn(self._login())).result()
+
+    @property
+    def cdn_pool(self) -> CDNPool:
+        # the content server list is public, no need to log in for it
+        with self._lock:
+            if self._cdn_pool is None:
+                from steam.client.cdn import get_content_servers_from_webapi
+
+                cell_id = self._client.cell_id if self._client else 0
+                servers = get_content_servers_from_webapi(cell_id)
+                self._cdn_pool = CDNPool(server for server in servers if server.type != "OpenCache")
+            return self._cdn_pool
+
+    @property
+    def mrc_session(self) -> "requests.Session":
+        with self._lock:
+            if self._mrc_session is None:
+                self._mrc_session = initialize_mrc_session()
+            return self._mrc_session
+
+    @property
+    def mrc_limiter(self) -> RateLimiter:
+        with self._lock:
+            if self._mrc_limiter is None:
+                self._mrc_limiter = RateLimiter(self.api_rate)
+            return self._mrc_limiter
+
+    def cached_request_code(self, key: tuple[int, int, int]) -> str | None:
+        with self._lock:
+            if (cached := self.request_codes.get(key)) and cached[0] > time.monotonic():
+                return cached[1]
+            return None
+
+    def cache_request_code(self, key: tuple[int, int, int], code: str):
+        with self._lock:
+            now = time.monotonic()
+            # kept in order of expiry, so that a long lived session only holds the codes still valid
+            self.request_codes.pop(key, None)
+            self.request_codes[key] = (now + REQUEST_CODE_TTL, code)
+            expired = [old for old, _ in itertools.takewhile(lambda item: item[1][0] <= now, self.request_codes.items())]
+            for old in expired:
+                del self.request_codes[old]
+
+    def login(self):
+        self.run_client(lambda client: client)
+
+    def close(self):
+        with self._lock:
+            if self._client_executor is not None:
+                if self._client is not None:
+                    self._client_executor.submit(self._client.logout).result()
+                    self._client = None
+                self._client_executor.shutdown()
+                self._client_executor = None
+            if self._cdn_pool is not None:
+                for connection in self._cdn_pool.connections:
+                    connection.session.close()
+                self._cdn_pool = None
+            if self._mrc_session is not None:
+                self._mrc_session.close()
+                self._mrc_session = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def parse_metadata(appid: int, app: dict) -> AppMetadata:
     depot_infos: DepotInfos = {}
     for id, depot in app["depots"].items():
         try:
@@ -60,7 +377,7 @@ def fetch_metadata(client: SteamClient, appid: int) -> tuple[AppInfo, DepotInfos
             )
         except Exception:
             continue
-    return (
+    return AppMetadata(
         AppInfo(
             appid,
             app["common"]["name"],
@@ -68,53 +385,113 @@ def fetch_metadata(client: SteamClient, appid: int) -> tuple[AppInfo, DepotInfos
             int(app["depots"]["branches"]["public"]["buildid"]),
         ),
         depot_infos,
+        app.get("_change_number"),
     )
 
 
-def fetch_manifest_request_code(appid: int, depot: int, gid: int) -> str:
-    url = args.api_url.format(appid=appid, depotid=depot, manifestid=gid)
+def fetch_metadata(session: SteamSession, appids: Iterable[int]) -> dict[int, AppMetadata]:
+    appids = list(dict.fromkeys(appids))
+    metadata: dict[int, AppMetadata] = {}
+    for i in range(0, len(appids), PRODUCT_INFO_CHUNK_SIZE):
+        chunk = appids[i : i + PRODUCT_INFO_CHUNK_SIZE]
+        try:
+            product_info = session.run_client(lambda client, chunk=chunk: client.get_product_info(chunk, auto_access_tokens=False))
+            if product_info is None:
+                raise KeyError("apps", "No response from steam api")
+        except Exception as ex:
+            logger.error(f"Failed to fetch product info for {len(chunk)} apps:")
+            logger.error(ex)
+            continue
+        for appid in chunk:
+            try:
+                metadata[appid] = parse_metadata(appid, product_info["apps"][appid])
+            except Exception as ex:
+                logger.error(f"Failed to parse product info for app {appid}: {ex!r}")
+    return metadata
+
+
+def fetch_change_numbers(session: SteamSession, appids: Iterable[int]) -> dict[int, int]:
+    appids = list(dict.fromkeys(appids))
+    change_numbers: dict[int, int] = {}
+    for i in range(0, len(appids), PRODUCT_INFO_CHUNK_SIZE):
+        chunk = appids[i : i + PRODUCT_INFO_CHUNK_SIZE]
+        try:
+            product_info = session.run_client(
+                lambda client, chunk=chunk: client.get_product_info(chunk, meta_data_only=True, auto_access_tokens=False)
+            )
+            if product_info is None:
+                raise KeyError("apps", "No response from steam api")
+        except Exception as ex:
+            logger.error(f"Failed to fetch change numbers for {len(chunk)} apps:")
+            logger.error(ex)
+            continue
+        for appid, app in product_info["apps"].items():
+            change_numbers[appid] = app["_change_number"]
+    return change_numbers
+
+
+def fetch_manifest_request_code(session: SteamSession, api_url: str, metrics: Metrics, appid: int, depot: int, gid: int) -> str:
+    key = (appid, depot, gid)
+    if (cached := session.cached_request_code(key)) is not None:
+        logger.info(f"Using cached request code for manifest {gid}")
+        metrics.count("request_code_cache_hits")
+        return cached
+
+    url = api_url.format(appid=appid, depotid=depot, manifestid=gid)
     logger.info(f"Fetching request code from: {url}")
-    response = mrc_session.get(url, timeout=10)
-    assert response.status_code == 200
+    for _ in range(REQUEST_CODE_ATTEMPTS):
+        session.mrc_limiter.acquire()
+        response = session.mrc_session.get(url, timeout=10)
+        if response.status_code != 429:
+            break
+        metrics.count("request_code_retries")
+        session.mrc_limiter.throttled(retry_after(response))
+    else:
+        raise OSError(f"Request code endpoint still rate limited after {REQUEST_CODE_ATTEMPTS} attempts")
+    response.raise_for_status()
+    session.mrc_limiter.succeeded()
+    session.cache_request_code(key, response.text)
     return response.text
 
 
-def decompress_manifest(manifest: bytes):
-    with zipfile.ZipFile(io.BytesIO(manifest)) as zip_file:
-        zip = zipfile.Path(zip_file)
-        for child in (zip / path for path in zip_file.namelist()):
-            if child.is_file():
-                return child.read_bytes()
+def decompress_manifest(src: Path, dst: Path):
+    with zipfile.ZipFile(src) as zip_file:
+        for info in zip_file.infolist():
+            if not info.is_dir():
+                with zip_file.open(info) as src_file, atomic_open(dst) as dst_file:
+                    shutil.copyfileobj(src_file, dst_file, DOWNLOAD_CHUNK_SIZE)
+                return
     raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), "file")
 
 
 def fetch_manifest(
-    cdn_client: CDNClient,
+    session: SteamSession,
+    api_url: str,
+    metrics: Metrics,
     appid: int,
     depot: int,
     gid: int,
+    path: Path,
 ) -> Manifest:
-    server: ContentServer = cdn_client.get_content_server()
-    server_url = URL("").with_components(
-        hostname=server.host,
-        port=server.port,
-        scheme="https" if server.https else "http",
-    )
     try:
-        code = fetch_manifest_request_code(appid, depot, gid)
+        with metrics.phase("request_code", depot):
+            code = fetch_manifest_request_code(session, api_url, metrics, appid, depot, gid)
     except Exception:
         logger.error("Failed to retrieve manifest request code")
         raise
 
-    url: URL = server_url / "depot" / depot / "manifest" / gid / 5 / code
-
-    logger.info(f"Download manifest from {url}")
-    response = url.get()
-    assert response.status_code == 200
-    manifest = response.content
+    # stream to disk next to the destination, the manifest is never held in memory
+    download_path = temp_path(path.with_name(f"{path.name}.download"))
     try:
-        manifest = decompress_manifest(manifest)
-        logger.info(f"Manifest {gid} decompressed")
-    except Exception:
-        logger.info(f"Manifest {gid} likely uncompressed")
-    return Manifest(gid, manifest)
+        with metrics.phase("download", depot):
+            session.cdn_pool.download(f"depot/{depot}/manifest/{gid}/5/{code}", download_path, metrics, depot)
+        if zipfile.is_zipfile(download_path):
+            with metrics.phase("decompress", depot):
+                decompress_manifest(download_path, path)
+            logger.info(f"Manifest {gid} decompressed")
+        else:
+            logger.info(f"Manifest {gid} likely uncompressed")
+            os.replace(download_path, path)
+    finally:
+        download_path.unlink(missing_ok=True)
+    return Manifest(gid, path)
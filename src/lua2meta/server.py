@@ -0,0 +1,257 @@
+import hmac
+import itertools
+import json
+import os
+import signal
+import socketserver
+import threading
+import time
+import typing
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+from lua2meta import check_options, process
+from lua2meta.args import parse_serve_args, to_options
+from lua2meta.logger import logger
+from lua2meta.metrics import Metrics
+from lua2meta.network import SteamSession
+from lua2meta.types import Options, Result
+
+__all__ = ["JobQueue", "main"]
+
+# finished jobs kept for status queries, oldest are dropped first
+JOB_HISTORY = 1000
+# fixed by the shared session, or naming programs and files outside of the job's outputs, which clients must not choose
+SERVER_OPTIONS = {"api_rate", "downloader", "downloader_args", "config", "index_path", "manifest_store", "cache_dir"}
+MAX_REQUEST_SIZE = 1 << 20
+
+
+def options_from_json(defaults: Options, data: Any) -> Options:
+    if not isinstance(data, dict):
+        raise TypeError("options must be an object")
+    options: dict[str, Any] = {}
+    for field, value in data.items():
+        if field not in Options._fields:
+            raise ValueError(f"Unknown option {field!r}")
+        if field in SERVER_OPTIONS:
+            raise ValueError(f"Option {field!r} can only be set when starting the server")
+        if value is not None and Path in (Options.__annotations__[field], *typing.get_args(Options.__annotations__[field])):
+            value = Path(value)
+        options[field] = value
+    return defaults._replace(**options)
+
+
+class Job:
+    id: int
+    path: Path
+    options: Options
+    state: str  # queued, running, finished, failed
+    result: Result | None
+    error: str | None
+    metrics: Metrics
+    submitted: float
+    started: float | None
+    finished: float | None
+
+    def __init__(self, id: int, path: Path, options: Options):
+        self.id = id
+        self.path = path
+        self.options = options
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.metrics = Metrics()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "path": str(self.path),
+            "state": self.state,
+            "appid": self.result.appid if self.result else None,
+            "status": self.result.status if self.result else None,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "metrics": self.metrics.report(),
+        }
+
+
+class JobQueue:
+    session: SteamSession
+    defaults: Options
+    jobs: dict[int, Job]
+    _ids: itertools.count
+    _executor: ThreadPoolExecutor
+    _lock: threading.Lock
+
+    def __init__(self, session: SteamSession, defaults: Options, workers: int):
+        self.session = session
+        self.defaults = defaults
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+
+    def submit(self, path: Path, options: Options) -> Job:
+        options = check_options(options)
+        with self._lock:
+            job = Job(next(self._ids), path, options)
+            self.jobs[job.id] = job
+            finished = [id for id, other in self.jobs.items() if other.finished is not None]
+            for id in finished[: max(0, len(finished) - JOB_HISTORY)]:
+                del self.jobs[id]
+        self._executor.submit(self._run, job)
+        logger.info(f'Job {job.id} queued for "{path}"')
+        return job
+
+    def _run(self, job: Job):
+        job.state = "running"
+        job.started = time.time()
+        try:
+            job.result = process(job.path, job.options, self.session, job.metrics)
+            job.state = "finished"
+            logger.info(f"Job {job.id} finished with status {job.result.status}")
+        except Exception as ex:
+            job.error = str(ex)
+            job.state = "failed"
+            logger.error(f"Job {job.id} failed: {ex}")
+        job.finished = time.time()
+
+    def list(self) -> list[Job]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs {"path": ..., "options": {...}}, GET /jobs, GET /jobs/<id>
+    queue: JobQueue
+    token: str | None
+
+    def send_json(self, status: HTTPStatus, body: Any):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self) -> bool:
+        if self.token is None:
+            return True
+        if hmac.compare_digest(self.headers.get("Authorization", "").encode(), f"Bearer {self.token}".encode()):
+            return True
+        self.send_json(HTTPStatus.UNAUTHORIZED, {"error": "unauthorized"})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self.send_json(HTTPStatus.OK, [job.to_json() for job in self.queue.list()])
+        elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit() and (job := self.queue.jobs.get(int(parts[1]))):
+            self.send_json(HTTPStatus.OK, job.to_json())
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.strip("/") != "jobs":
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        # browsers cannot send JSON to another origin without a CORS preflight, which is never answered
+        if self.headers.get_content_type() != "application/json":
+            self.send_json(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, {"error": "Content-Type must be application/json"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_SIZE:
+            self.send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "request too large"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length))
+            if not isinstance(body, dict) or not isinstance(body.get("path"), str):
+                raise TypeError('"path" is required')
+            options = options_from_json(self.queue.defaults, body.get("options", {}))
+            job = self.queue.submit(Path(body["path"]), options)
+        except (OSError, ValueError, TypeError) as ex:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(ex)})
+            return
+        self.send_json(HTTPStatus.ACCEPTED, job.to_json())
+
+    def address_string(self) -> str:
+        # unix socket peers have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format: str, *args: Any):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    args = parse_serve_args(argv)
+    try:
+        defaults = check_options(to_options(args))
+    except (OSError, ValueError) as ex:
+        logger.error(ex)
+        return 1
+    if args.workers < 1:
+        logger.error(f"Invalid number of workers {args.workers}, must be at least 1")
+        return 1
+    token: str | None = None
+    if args.token_file:
+        try:
+            token = args.token_file.read_text().strip()
+        except OSError as ex:
+            logger.error(f"Failed to read token: {ex}")
+            return 1
+        if not token:
+            logger.error(f"Token file {args.token_file} is empty")
+            return 1
+
+    with SteamSession(defaults.api_rate) as session:
+        queue = JobQueue(session, defaults, args.workers)
+        # a Unix socket is protected by its permissions
+        handler = type("Handler", (RequestHandler,), {"queue": queue, "token": None if args.socket else token})
+        try:
+            if args.socket:
+                if args.socket.is_socket():
+                    args.socket.unlink()
+                server = UnixHTTPServer(str(args.socket), handler)
+                address = str(args.socket)
+            else:
+                server = ThreadingHTTPServer((args.host, args.port), handler)
+                address = f"http://{args.host}:{server.server_port}"
+        except OSError as ex:
+            logger.error(f"Failed to listen: {ex}")
+            queue.shutdown()
+            return 1
+
+        # shutdown() waits for serve_forever, which runs on this thread
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        logger.info(f"Serving on {address} with {args.workers} workers")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket:
+                os.unlink(args.socket)
+            logger.info("Waiting for running jobs")
+            queue.shutdown()
+    return 0
@@ -0,0 +1,29 @@
+from pathlib import Path
+
+from lua2meta.types import Manifest
+from lua2meta.utils import link_or_copy
+
+__all__ = ["ManifestStore"]
+
+
+class ManifestStore:
+    # a manifest never changes for a given depot and gid, so they are shared between apps and runs
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def manifest_path(self, depot: int, gid: int) -> Path:
+        return self.path / str(depot) / f"{depot}_{gid}.manifest"
+
+    def get(self, depot: int, gid: int) -> Manifest | None:
+        path = self.manifest_path(depot, gid)
+        return Manifest(gid, path) if path.is_file() else None
+
+    def put(self, depot: int, gid: int, src: Path):
+        path = self.manifest_path(depot, gid)
+        if path.is_file():
+            return
+        path.parent.mkdir(exist_ok=True)
+        link_or_copy(src, path)
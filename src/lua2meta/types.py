@@ -2,21 +2,38 @@ from pathlib import Path
 from typing import NamedTuple
 
 __all__ = [
-    "DepotKeys",
-    "Manifest",
+    "AppInfo",
+    "AppInput",
+    "AppMetadata",
+    "BundledManifests",
     "DepotInfo",
     "DepotInfos",
+    "DepotKeys",
     "DepotManifests",
     "InputContent",
-    "AppInfo",
+    "Manifest",
+    "ManifestContent",
+    "Options",
+    "Result",
+    "SharedDepots",
+    "ZipMember",
 ]
 
 type DepotKeys = dict[int, str]
 
 
+class ZipMember(NamedTuple):
+    archive: Path
+    name: str
+
+
+# a file or zip member holding the manifest
+type ManifestContent = Path | ZipMember
+
+
 class Manifest(NamedTuple):
     gid: int
-    content: bytes
+    content: ManifestContent
 
 
 class DepotInfo(NamedTuple):
@@ -27,11 +44,12 @@ class DepotInfo(NamedTuple):
 
 type DepotInfos = dict[int, DepotInfo]
 type DepotManifests = dict[int, Manifest]
+type BundledManifests = dict[int, list[Manifest]]  # every manifest of each depot in an input, in archive order
 
 
 class InputContent(NamedTuple):
     lua_src: str
-    manifests: DepotManifests
+    manifests: BundledManifests
 
 
 class AppInfo(NamedTuple):
@@ -39,3 +57,58 @@ class AppInfo(NamedTuple):
     name: str
     install_dir: Path
     build_id: int
+
+
+class AppMetadata(NamedTuple):
+    app_info: AppInfo
+    depot_infos: DepotInfos
+    change_number: int | None = None
+
+
+class AppInput(NamedTuple):
+    path: Path
+    appid: int
+    depot_keys: DepotKeys
+    manifests: DepotManifests
+    lua_manifests: DepotInfos  # gids and sizes from setManifestid()
+
+
+class SharedDepots(NamedTuple):
+    # (depot, gid) pairs that an earlier app of the same batch already handled
+    manifests: dict[tuple[int, int], Manifest]  # written to the output directory, or to a bundle from this content
+    downloads: dict[tuple[int, int], Path]  # downloaded to the directory
+
+
+class Options(NamedTuple):
+    appid: int | None = None
+    depots: list[int] | None = None
+    out_dir: Path = Path(".")
+    acf_dir: Path | None = None  # defaults to out_dir
+    bundle: bool = False
+    offline: bool = False
+    update: bool = False
+    delta: bool = False
+    cache_dir: Path | None = None
+    cache_ttl: float = 3600
+    cache_validate: bool = False
+    api_url: str | None = None
+    api_rate: float | None = None
+    manifest_store: Path | None = None
+    index_path: Path | None = None
+    skip_indexed: bool = False
+    jobs: int = 1
+    config: Path | None = None
+    download_dir: Path | None = None  # defaults to out_dir
+    dry_download: bool = False
+    download_jobs: int = 1
+    pipeline: bool = False
+    keep_going: bool = False
+    redownload: bool = False
+    downloader: Path = Path("DepotDownloaderMod.exe")
+    downloader_args: str | None = None
+
+
+class Result(NamedTuple):
+    path: Path
+    appid: int | None
+    status: int
@@ -1,4 +1,11 @@
-from typing import Any, overload
+import os
+import shutil
+import sys
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, BinaryIO, overload
 
 
 @overload
@@ -29,3 +36,78 @@ def dict_subtract[K, V](dict1: dict[K, V], e2: dict[K, Any] | set[K]) -> dict[K,
 
 def dict_copyorder[K, V](dict: dict[K, V], ref: dict[K, Any]) -> dict[K, V]:
     return {key: dict[key] for key in ref.keys() if key in dict}
+
+
+FICLONE = 0x40049409
+
+
+def temp_path(path: Path) -> Path:
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _reflink(src: Path, dst: Path):
+    import fcntl
+
+    with src.open("rb") as src_file, dst.open("wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+@contextmanager
+def atomic_open(path: Path) -> Iterator[BinaryIO]:
+    # readers never see a partially written file, and hardlinks to the previous file are left untouched
+    partial_path = temp_path(path)
+    try:
+        with partial_path.open("wb") as file:
+            yield file
+        os.replace(partial_path, path)
+    finally:
+        partial_path.unlink(missing_ok=True)
+
+
+def atomic_write_bytes(path: Path, content: bytes):
+    with atomic_open(path) as file:
+        file.write(content)
+
+
+def link_or_copy(src: Path, dst: Path):
+    # hardlink, reflink or plain copy, whichever the filesystem supports first. dst is replaced atomically
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    partial_path = temp_path(dst)
+    try:
+        try:
+            os.link(src, partial_path)
+        except OSError:
+            try:
+                if not sys.platform.startswith("linux"):
+                    raise OSError
+                _reflink(src, partial_path)
+            except OSError:
+                shutil.copyfile(src, partial_path)
+        os.replace(partial_path, dst)
+    finally:
+        partial_path.unlink(missing_ok=True)
+
+
+def copy_range(src: IO[bytes], offset: int, size: int, dst: IO[bytes]):
+    # size bytes from offset in src, appended to dst. Copied within the kernel where the platform and filesystems allow
+    dst.flush()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    try:
+        while size:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src_fd, dst_fd, size, offset)
+            else:
+                copied = os.sendfile(dst_fd, src_fd, offset, size)
+            if not copied:
+                raise EOFError(f"Unexpected end of file at {offset}")
+            offset += copied
+            size -= copied
+    except (AttributeError, OSError):
+        # sendfile is missing on Windows, and only writes to sockets on macOS
+        src.seek(offset)
+        while size:
+            if not (chunk := src.read(min(size, 1 << 20))):
+                raise EOFError(f"Unexpected end of file at {offset}") from None
+            dst.write(chunk)
+            size -= len(chunk)
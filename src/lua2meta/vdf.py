@@ -1,14 +1,18 @@
-from typing import cast
-import vdf
-from vdf import VDFDict
+from pathlib import Path
+from typing import TYPE_CHECKING, cast
 
-from lua2meta.args import args
+from lua2meta.index import ArchiveIndex
 from lua2meta.types import AppInfo, DepotInfo, DepotInfos, DepotKeys
 
-__all__ = ["write_acf", "write_config"]
+if TYPE_CHECKING:
+    from vdf import VDFDict
 
+__all__ = ["dumps_acf", "merge_config", "write_acf"]
+
+
+def dumps_acf(app_info: AppInfo, depot_infos: DepotInfos) -> str:
+    import vdf
 
-def write_acf(app_info: AppInfo, depot_infos: DepotInfos):
     def installed_depot(depot_info: DepotInfo):
         value = {"manifest": depot_info.gid, "size": depot_info.size}
         if depot_info.dlc_app_id is not None:
@@ -26,15 +30,31 @@ def write_acf(app_info: AppInfo, depot_infos: DepotInfos):
             "InstalledDepots": {depot: installed_depot(depot_info) for depot, depot_info in depot_infos.items()},
         }
     }
-    (args.acf_dir / f"appmanifest_{app_info.appid}.acf").write_text(vdf.dumps(acf_contents, pretty=True))
-
-
-def write_config(depot_keys: DepotKeys):
-    with args.config.open(mode="r+") as config_file:
-        config = cast(VDFDict, vdf.load(config_file, mapper=VDFDict))
-        t = config["InstallConfigStore"]["Software"]["valve"]["Steam"]
-        # deduplicate depots
-        t["depots"] = t["depots"] | {str(depot): {"DecryptionKey": key} for depot, key in depot_keys.items()}
-        config_file.seek(0)
-        vdf.dump(config, config_file, pretty=True)
-        config_file.truncate()
+    return vdf.dumps(acf_contents, pretty=True)
+
+
+def write_acf(acf_dir: Path, app_info: AppInfo, depot_infos: DepotInfos, index: ArchiveIndex | None):
+    acf_path = acf_dir / f"appmanifest_{app_info.appid}.acf"
+    acf_path.write_text(dumps_acf(app_info, depot_infos))
+    if index:
+        index.put_app(acf_path, app_info, depot_infos)
+
+
+def merge_config(src: str, depot_keys: DepotKeys) -> str | None:
+    # None when every key is already in the config
+    import vdf
+    from vdf import VDFDict
+
+    config = cast("VDFDict", vdf.loads(src, mapper=VDFDict))
+    depots = config["InstallConfigStore"]["Software"]["valve"]["Steam"]["depots"]
+    changed = False
+    for depot, key in depot_keys.items():
+        if str(depot) not in depots:
+            depots[str(depot)] = {"DecryptionKey": key}
+        elif depots[str(depot)].get("DecryptionKey") != key:
+            # a plain str key would add a duplicate entry to a VDFDict, the tuple replaces the first one
+            depots[(0, str(depot))] = {"DecryptionKey": key}
+        else:
+            continue
+        changed = True
+    return vdf.dumps(config, pretty=True) if changed else None
@@ -0,0 +1,219 @@
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import signal
+import struct
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from lua2meta import process
+from lua2meta.logger import logger
+from lua2meta.metrics import Metrics
+from lua2meta.network import SteamSession
+from lua2meta.types import Options
+
+__all__ = ["watch"]
+
+STATE_NAME = ".lua2meta-watched"
+SUFFIXES = (".lua", ".zip")
+POLL_INTERVAL = 1.0
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+_EVENT = struct.Struct("iIII")
+
+type Signature = tuple[int, int] | None
+
+
+def signature(path: Path) -> Signature:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def is_input(path: Path) -> bool:
+    return path.suffix in SUFFIXES and not path.name.startswith(".")
+
+
+class InotifyWatcher:
+    # names of the entries that changed in the directory, None when events were lost and everything has to be rescanned
+    fd: int
+
+    def __init__(self, directory: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), str(directory))
+
+    def wait(self, timeout: float) -> set[str] | None:
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names: set[str] = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size : offset + _EVENT.size + length].rstrip(b"\x00")
+            offset += _EVENT.size + length
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                raise FileNotFoundError("The watched directory was removed")
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    directory: Path
+    signatures: dict[str, Signature]
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.signatures = self.scan()
+
+    def scan(self) -> dict[str, Signature]:
+        return {path.name: signature(path) for path in self.directory.iterdir() if is_input(path)}
+
+    def wait(self, timeout: float) -> set[str] | None:
+        time.sleep(min(timeout, POLL_INTERVAL))
+        if not self.directory.is_dir():
+            raise FileNotFoundError("The watched directory was removed")
+        signatures = self.scan()
+        changed = {name for name, value in signatures.items() if self.signatures.get(name) != value}
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class WatchState:
+    # content hashes of the inputs processed successfully, one per line and only ever appended
+    path: Path
+    hashes: set[str]
+
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            self.hashes = set(self.path.read_text().split())
+        except FileNotFoundError:
+            self.hashes = set()
+
+    def add(self, digest: str):
+        with self.path.open("a") as file:
+            file.write(digest + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.hashes.add(digest)
+
+
+def file_hash(path: Path) -> str:
+    with path.open("rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def watch(directory: Path, options: Options, debounce: float, metrics: Metrics, processed: Callable[[], None]) -> int:
+    state = WatchState(directory / STATE_NAME)
+    try:
+        watcher: InotifyWatcher | PollingWatcher = InotifyWatcher(directory)
+    except (OSError, AttributeError) as ex:
+        # not Linux, or out of inotify instances
+        logger.warning(f"inotify is unavailable, polling every {POLL_INTERVAL:g}s instead: {ex}")
+        watcher = PollingWatcher(directory)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    # path -> (deadline, signature when last seen changing). An input is processed once it kept the same size and
+    # modification time for the debounce period, so that files still being copied in are not read half written
+    pending: dict[Path, tuple[float, Signature]] = {}
+
+    def changed(path: Path):
+        if is_input(path):
+            pending[path] = (time.monotonic() + debounce, signature(path))
+
+    def rescan():
+        for path in sorted(directory.iterdir()):
+            changed(path)
+
+    logger.info(f'Watching "{directory}" for .lua and .zip inputs')
+    with SteamSession(options.api_rate) as session:
+        try:
+            rescan()
+            while not stop.is_set():
+                now = time.monotonic()
+                for path, (deadline, last) in sorted(pending.items()):
+                    if deadline > now:
+                        continue
+                    del pending[path]
+                    if (current := signature(path)) is None:
+                        continue
+                    if current != last:
+                        pending[path] = (now + debounce, current)
+                        continue
+                    try:
+                        digest = file_hash(path)
+                    except OSError as ex:
+                        logger.error(f'Failed to read "{path}": {ex}')
+                        continue
+                    if digest in state.hashes:
+                        logger.debug(f'"{path}" was already processed')
+                        continue
+
+                    logger.info(f'Processing "{path}"')
+                    try:
+                        result = process(path, options, session, metrics)
+                    except Exception as ex:
+                        logger.error(f'Failed to process "{path}": {ex}')
+                        continue
+                    finally:
+                        processed()
+                    if result.status == 0:
+                        state.add(digest)
+                        logger.info(f'Processed app {result.appid} from "{path}"')
+                    else:
+                        # retried when the file changes, or on restart
+                        logger.error(f'Processing "{path}" failed with status {result.status}')
+
+                timeout = min((deadline for deadline, _ in pending.values()), default=now + POLL_INTERVAL) - time.monotonic()
+                names = watcher.wait(max(0.0, min(timeout, POLL_INTERVAL)))
+                if names is None:
+                    logger.warning("Missed some file events, rescanning")
+                    rescan()
+                else:
+                    for name in names:
+                        changed(directory / name)
+        except KeyboardInterrupt:
+            pass
+        except FileNotFoundError as ex:
+            logger.error(ex)
+            return 1
+        finally:
+            watcher.close()
+    return 0